@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+'''Recall and speed of the mkindex prefilter against exhaustive search.
+
+Hits of an exhaustive search (e-value below --thr) are compared with the hits
+found with the index for several --nprobe values. One JSON line is printed for
+exhaustive search and for every nprobe value.'''
+import json
+import time
+import click
+import numpy as np
+import scipy.stats as st
+from pyprost.prdb import loadDB
+from pyprost.prosttools import l1Distances
+from pyprost.index import buildIndex,loadIndex,probe
+
+def evalues(dbdiff, null, ldb):
+    m = np.median(null)
+    s = st.median_abs_deviation(null)*1.4826
+    return st.norm.cdf((dbdiff-m)/s)*ldb
+
+@click.command()
+@click.option('--thr', default=0.05, help='E-value threshold of a hit')
+@click.option('--index', default=None, type=click.Path(exists=True), help='Index created with mkindex, built here when missing')
+@click.option('--nprobe', default='1,4,16,32,64,128', help='Comma separated nprobe values')
+@click.option('--queries', default=200, help='Number of queries to evaluate')
+@click.argument('querydb', type=click.Path(exists=True))
+@click.argument('targetdb', type=click.Path(exists=True))
+def main(thr, index, nprobe, queries, querydb, targetdb):
+    _,qdb = loadDB(querydb)
+    _,tdb = loadDB(targetdb)
+    qdb = np.asarray(qdb[:queries])
+    ldb = len(tdb)
+    if index is None:
+        t = time.time()
+        index = buildIndex(tdb)
+        print(json.dumps({'stage':'build','clusters':len(index['centroids']),'seconds':time.time()-t}))
+    else: index = loadIndex(index)
+
+    t = time.time()
+    truth = []
+    for dbdiff in l1Distances(qdb,tdb):
+        truth.append(set(np.nonzero(evalues(dbdiff,dbdiff,ldb) < thr)[0]))
+    exhaustive = time.time()-t
+    nhits = sum(len(h) for h in truth)
+    print(json.dumps({'stage':'exhaustive','queries':len(qdb),'targets':ldb,'hits':nhits,
+                      'seconds':exhaustive,'queries_per_second':len(qdb)/exhaustive}))
+
+    nulldb = np.asarray(tdb[index['null']])
+    for n in [int(x) for x in nprobe.split(',')]:
+        t = time.time()
+        found,scored = 0,0
+        null = l1Distances(qdb,nulldb)
+        for q,ids,nd,hits in zip(qdb,probe(index,qdb,n),null,truth):
+            e = evalues(l1Distances(q,tdb[ids])[0],nd,ldb)
+            found += len(hits & set(ids[e < thr]))
+            scored += len(ids)
+        elapsed = time.time()-t
+        print(json.dumps({'stage':'index','nprobe':n,'recall':found/max(nhits,1),'scored_fraction':scored/(len(qdb)*ldb),
+                          'seconds':elapsed,'queries_per_second':len(qdb)/elapsed,'speedup':exhaustive/elapsed}))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+'''Speed and accuracy of embedding longer than 1022 residue sequences.
+
+Speed: random sequences of every --lengths value are embedded with the legacy
+method, one piece after the other and concatenated, and with embed, which runs
+equal length pieces through the model in batches. One JSON line is printed per
+length with both times and the largest difference of the two results.
+
+Accuracy: without a longer context model there is no reference for sequences
+longer than 1022 residues, so --accuracy sequences up to 1022 residues are cut
+into windows of --window residues instead and compared with their full context
+embedding. One JSON line is printed per --overlap value with the mean relative
+error of the last layer embedding and the mean L1 distance between the
+quantizations.'''
+import json
+import time
+import click
+import numpy as np
+from pyprost.esmts25_13 import _embed,embed
+from pyprost.prosttools import quantEmb
+
+AMINO = np.array(list('ACDEFGHIKLMNPQRSTVWY'))
+
+def legacy(seq):
+    #embed before batching: contiguous pieces embedded one by one
+    l = len(seq)
+    piece = int(l/1022)+1
+    part = l/piece
+    embs = [_embed(seq[int(i*part):int((i+1)*part)]) for i in range(piece)]
+    return [np.concatenate([e[k][:-1] if i == 0 else e[k][1:] if i == piece-1 else e[k][1:-1]
+                            for i,e in enumerate(embs)]) for k in range(len(embs[0]))]
+
+@click.command()
+@click.option('--lengths', default='1500,3000,6000,12000,35000', help='Comma separated sequence lengths of the speed test')
+@click.option('--repeat', default=2, help='Timed runs per length, the fastest is reported')
+@click.option('--max-tokens', default=4096, help='Batch size of embed in tokens')
+@click.option('--accuracy', default=20, help='Number of sequences of the accuracy test')
+@click.option('--window', default=256, help='Window length of the accuracy test')
+@click.option('--overlap', default='0,32,64,128', help='Comma separated overlaps of the accuracy test')
+@click.option('--seed', default=0)
+@click.option('--fasta', default=None, type=click.Path(exists=True), help='Take the accuracy test sequences from this file instead of random ones')
+def main(lengths, repeat, max_tokens, accuracy, window, overlap, seed, fasta):
+    rng = np.random.default_rng(seed)
+    _embed('M')   #load the model outside of the timings
+    for l in [int(x) for x in lengths.split(',')]:
+        seq = ''.join(rng.choice(AMINO,l))
+        times = {}
+        for name,f in [('legacy',legacy),('batched',lambda s: embed(s,0,max_tokens))]:
+            best = np.inf
+            for _ in range(repeat):
+                t = time.time()
+                out = f(seq)
+                best = min(best,time.time()-t)
+            times[name] = (best,out)
+        diff = max(float(np.abs(a-b).max()) for a,b in zip(times['legacy'][1],times['batched'][1]))
+        print(json.dumps({'stage':'speed','length':l,'legacy_seconds':times['legacy'][0],'batched_seconds':times['batched'][0],
+                          'speedup':times['legacy'][0]/times['batched'][0],'max_abs_difference':diff}))
+
+    if fasta is not None:
+        with open(fasta) as f:
+            seqs = ''.join(l.strip() if l[0] != '>' else '\n' for l in f).split()
+        seqs = [s.upper() for s in seqs if window < len(s) <= 1022][:accuracy]
+    else: seqs = [''.join(rng.choice(AMINO,rng.integers(2*window,1023))) for _ in range(accuracy)]
+    full = [_embed(s) for s in seqs]
+    fullq = [quantEmb(e).astype(np.int32) for e in full]
+    for o in [int(x) for x in overlap.split(',')]:
+        err,qdist = [],[]
+        for s,f,fq in zip(seqs,full,fullq):
+            e = embed(s,o,max_tokens,window)
+            err.append(np.linalg.norm(e[1][1:-1]-f[1][1:-1])/np.linalg.norm(f[1][1:-1]))
+            qdist.append(np.abs(quantEmb(e).astype(np.int32)-fq).sum())
+        print(json.dumps({'stage':'accuracy','window':window,'overlap':o,'sequences':len(seqs),
+                          'relative_error':float(np.mean(err)),'quant_l1':float(np.mean(qdist))}))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+'''Distance and e-value fidelity of packed 4 and 6 bit databases.
+
+The target database is packed in memory like makedb --bits and the queries are
+scored against the 8 bit baseline and the packed codes. One JSON line is printed
+for every code width with the bytes per entry, the correlation and relative error
+of the distances, the recall and precision of the hits below --thr, the median
+absolute log10 e-value difference of the baseline hits, how often the best hit
+is unchanged and the search time.'''
+import json
+import time
+import click
+import numpy as np
+from scipy.special import ndtr
+from pyprost.prdb import loadDB
+from pyprost.prosttools import l1Distances,medianMAD,packQuants,packedRowBytes,PackedCodes
+
+def evalues(dists, ldb):
+    e = np.empty(dists.shape)
+    for i,d in enumerate(dists):
+        m,mad = medianMAD(d)
+        e[i] = ndtr((d-m)/(mad*1.4826))*ldb
+    return e
+
+@click.command()
+@click.option('--thr', default=0.05, help='E-value threshold of a hit')
+@click.option('--bits', default='4,6', help='Comma separated code widths')
+@click.option('--queries', default=200, help='Number of queries to evaluate')
+@click.argument('querydb', type=click.Path(exists=True))
+@click.argument('targetdb', type=click.Path(exists=True))
+def main(thr, bits, queries, querydb, targetdb):
+    _,qdb = loadDB(querydb)
+    _,tdb = loadDB(targetdb)
+    qdb = np.asarray(qdb[:queries])
+    tdb = np.asarray(tdb)
+    ldb = len(tdb)
+
+    t = time.time()
+    base = l1Distances(qdb,tdb)
+    elapsed = time.time()-t
+    e = evalues(base,ldb)
+    hits = e < thr
+    print(json.dumps({'bits':8,'bytes_per_entry':tdb.shape[1],'queries':len(qdb),'targets':ldb,
+                      'hits':int(hits.sum()),'seconds':elapsed}))
+
+    for b in [int(x) for x in bits.split(',')]:
+        packed = PackedCodes(packQuants(tdb,b),b,tdb.shape[1])
+        t = time.time()
+        dists = l1Distances(qdb,packed)
+        elapsed = time.time()-t
+        eb = evalues(dists,ldb)
+        hb = eb < thr
+        both = (hits & hb).sum()
+        logdiff = np.abs(np.log10(np.maximum(eb[hits],1e-300))-np.log10(np.maximum(e[hits],1e-300)))
+        print(json.dumps({'bits':b,'bytes_per_entry':packedRowBytes(tdb.shape[1],b),
+                          'dist_pearson':float(np.corrcoef(base.ravel(),dists.ravel())[0,1]),
+                          'dist_mean_rel_error':float(np.mean(np.abs(dists-base)/np.maximum(base,1))),
+                          'hits':int(hb.sum()),'recall':float(both/max(hits.sum(),1)),'precision':float(both/max(hb.sum(),1)),
+                          'evalue_median_log10_diff':float(np.median(logdiff)) if len(logdiff) else 0.0,
+                          'top1_agreement':float(np.mean(base.argmin(axis=1) == dists.argmin(axis=1))),
+                          'seconds':elapsed}))
+
+if __name__ == '__main__':
+    main()
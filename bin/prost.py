@@ -1,25 +1,28 @@
 #!/usr/bin/env python
 
 import numpy as np
-import scipy.stats as st
-from pickle import load,loads,dump,dumps
+from pickle import load,dump
 import click
-import blosc
-from statsmodels.stats.multitest import multipletests
 import re
 from datetime import datetime
+import time
 import json
 import sys
-from multiprocessing import Pool
+from multiprocessing import Pool,cpu_count,get_context
+from pyprost.prdb import loadDB,saveDB,convertDB,isPrdb2,PrdbWriter,ProstDB,ShardedNames,shardPaths
+from pyprost.prosttools import l1Distances,medianMAD,histMedianMAD
+from tempfile import TemporaryDirectory
+from contextlib import contextmanager
 
 import os
 from pathlib import Path
 if 'PROSTDIR' in os.environ: prostdir = os.environ['PROSTDIR']
 else: prostdir = str(Path.home())+'/.config/prost'
 
-from itertools import groupby
+from itertools import groupby,islice
+from collections import deque
 def fasta_iter(fastafile):
-    fh = open(fastafile)
+    fh = open(fastafile) if type(fastafile) == str else fastafile
     faiter = (x[1] for x in groupby(fh, lambda line: line[0] == ">"))
     for header in faiter:
         header = next(header)[1:].strip()
@@ -47,63 +50,99 @@ def parseName(name):
     else:
         return (res.group(1),res.group(2),res.group(3),res.group(4),res.group(5),res.group(6))
 
-def annotate(ind,evals,go,goFrq,goDesc):
-    spTotalCnt = goFrq['count']
-    gores = go[ind]
-
-    #count go term frequencies in the hits
-    totalCnt = 0
-    goDict = {}
-    for r in gores:
-        for term in r:
-            if term not in goDict: goDict[term] = 1
-            else: goDict[term] += 1
-            totalCnt += 1
-    #dont perform significance test on annotationless proteins, but count them
-    goDict.pop('', None)
-    if len(goDict) < 1: return []
-
-    #perform significance test
-    plist = []
-    for g,cnt in goDict.items():
-        contTable=[[cnt,goFrq[g]],[totalCnt,spTotalCnt]]
-        _,p,_,_ = st.chi2_contingency(contTable)
-        plist.append([g,p])
-    if len(plist) < 1: return []
-
-    #apply multiple p test correction
-    corrp = list(multipletests([s[1] for s in plist], method="bonferroni")[1])
-
-    #find p<0.001
+def _chi2Yates(a, b, c, d):
+    #p-values of the 2x2 tables [[a,b],[c,d]] computed like scipy.stats.chi2_contingency,
+    #Pearson's chi-square test with Yates' correction, for many tables at once
+    from scipy.special import chdtrc
+    obs = np.array(np.broadcast_arrays(a,b,c,d),dtype=np.float64)
+    n = obs[0]+obs[1]+obs[2]+obs[3]
+    rows,cols = (obs[0]+obs[1],obs[2]+obs[3]),(obs[0]+obs[2],obs[1]+obs[3])
+    exp = np.array([rows[0]*cols[0],rows[0]*cols[1],rows[1]*cols[0],rows[1]*cols[1]])/n
+    diff = exp-obs
+    obs = obs+np.minimum(0.5,np.abs(diff))*np.sign(diff)
+    terms = (obs-exp)**2/exp
+    return chdtrc(1,terms[0]+terms[1]+terms[2]+terms[3])
+
+def annotate(ind,evals,go):
+    from scipy.special import ndtr,ndtri
+    spTotalCnt = go['count']
+    indptr,indices,terms = go['indptr'],go['indices'],go['terms']
+    ind = np.asarray(ind,dtype=np.int64)
+    evals = np.asarray(evals)
+    if len(ind) < 1: return []
+
+    #go terms of the hits as (hit, term) pairs in hit order
+    starts,lens = indptr[ind],indptr[ind+1]-indptr[ind]
+    hit = np.repeat(np.arange(len(ind)),lens)
+    term = np.asarray(indices[np.arange(len(hit))+np.repeat(starts-np.cumsum(lens)+lens,lens)],dtype=np.int64)
+    totalCnt = len(term)
+    #terms in the order they first appear in the hits, first is the position of
+    #their first (hit, term) pair. Dont perform significance test on annotationless
+    #proteins, but count them
+    uniq,first = np.unique(term,return_index=True)
+    order = np.argsort(first)
+    uniq,first = uniq[order],first[order]
+    keep = uniq != go['empty']
+    uniq,first = uniq[keep],first[keep]
+    if len(uniq) < 1: return []
+    cnt = np.bincount(term)[uniq]
+
+    #perform significance test and apply bonferroni correction
+    p = _chi2Yates(cnt,go['freq'][uniq],totalCnt,spTotalCnt)
+    corrp = np.minimum(p*len(p),1)
+    sig = np.nonzero(corrp < 0.001)[0]
+    if len(sig) < 1: return []
+
+    #combine the e-values of the hits annotated with each significant term using stouffer's method
+    pairs = np.unique(hit*len(terms)+term)
+    pairHit,pairTerm = pairs//len(terms),pairs%len(terms)
+    lookup = np.full(len(terms),-1,dtype=np.int64)
+    lookup[uniq[sig]] = np.arange(len(sig))
+    s = lookup[pairTerm]
+    pairHit,s = pairHit[s >= 0],s[s >= 0]
+    z = -ndtri(1-np.exp(-evals[pairHit]))
+    n = np.bincount(s,minlength=len(sig))
+    p2 = ndtr(-(np.bincount(s,weights=z,minlength=len(sig))/np.sqrt(n)))
+    #apply multiple correction to new pval.
+    #Then multiply this with 10 to get 0.05-> 0.5 then substract this from 1 to get 0.5 confidence for 0.05 pval.
+    conf = 1-p2*n*10
+
+    #if combined e-values produces p<0.05 then and add the description
     significant = list()
-    for i,p in enumerate(corrp):
-        if p < 0.001:
-            #print(plist[i][0],goDesc[plist[i][0]])
-            prot_evals = []
-            prot_inds = []
-            for pind,prot in enumerate(ind):
-                if plist[i][0] in go[prot]:
-                    #print(prot,evals[pind])
-                    prot_evals.append(evals[pind])
-                    prot_inds.append(prot)
-            prot_pvals =  1 - np.exp(-np.array(prot_evals))
-            p2 = st.combine_pvalues(prot_pvals,method='stouffer')[1]
-            #apply multiple correction to new pval.
-            #Then multiply this with 10 to get 0.05-> 0.5 then substract this from 1 to get 0.5 confidence for 0.05 pval.
-            conf = 1-p2*len(prot_evals)*10
-            #print(len(prot_evals),p,p2,p2*len(prot_evals),conf)
-
-            #if combined e-values produces p<0.001 then and add the description
-            if p2 < 0.05:
-                significant.append([plist[i][0],goDesc[plist[i][0]],conf,prot_inds[0],prot_evals[0],len(prot_evals)])
-
-    #sort by the list by increasing p value
-    #significant.sort(reverse=False,key=lambda x: x[2])
+    for k in np.nonzero(p2 < 0.05)[0]:
+        t = terms[uniq[sig[k]]]
+        h = hit[first[sig[k]]]
+        significant.append([t,go['desc'][t],conf[k],ind[h],evals[h],n[k]])
 
     #sort by the list by decreasing confidence
     significant.sort(reverse=True,key=lambda x: x[2])
     return significant
 
+def loadGO(godb):
+    '''Reads a GO database created by mkgo as integer indexed tables.
+Annotations of protein i are terms[indices[indptr[i]:indptr[i+1]]] and
+freq holds the database frequency of each term.'''
+    with open(godb,'rb') as f:
+        go = load(f)
+    if type(go) == dict: return go
+    #older mkgo versions wrote [annotations, frequencies, descriptions] lists
+    return goTables(*go)
+
+def goTables(godbl, goFrq, goDesc):
+    '''Converts per protein GO term lists into a protein x term CSR matrix.'''
+    termId = {}
+    indptr = np.zeros(len(godbl)+1,dtype=np.int64)
+    indices = []
+    for i,l in enumerate(godbl):
+        for term in l:
+            if term not in termId: termId[term] = len(termId)
+            indices.append(termId[term])
+        indptr[i+1] = len(indices)
+    terms = list(termId.keys())
+    freq = np.array([goFrq[t] for t in terms],dtype=np.int64)
+    return {'indptr':indptr,'indices':np.array(indices,dtype=np.int32),'freq':freq,'terms':terms,
+            'empty':termId.get('',-1),'count':goFrq['count'],'desc':goDesc}
+
 @click.command()
 @click.argument('gocsv', type=click.Path(exists=True,file_okay=True,dir_okay=False))
 @click.argument('goobo', type=click.Path(exists=True,file_okay=True,dir_okay=False))
@@ -114,7 +153,8 @@ def mkgo(gocsv, goobo, prdb, out):
 mkcache command gets go tab file in csv format, GO descriptions in obo format,
 and a PROST database to create a go annotations file.
 
-It will create an output file that contains [go,freq,desc] lists.
+It will create an output file that contains the GO terms of the proteins as a
+sparse protein x term matrix with term frequencies and descriptions.
 '''
 
     print("Read the go csv file",gocsv)
@@ -125,8 +165,7 @@ It will create an output file that contains [go,freq,desc] lists.
             go[id] = (list(set(golist.replace(' ','').split(';'))))
 
     print("Read the PROST database",prdb)
-    with open(prdb,'rb') as f:
-        qnames,qdb = loads(blosc.decompress(f.read()))
+    qnames,qdb = loadDB(prdb)
 
     print("Gather GO annotations for proteins in the database")
     godb = np.empty(len(qnames),dtype=object)
@@ -191,7 +230,7 @@ It will create an output file that contains [go,freq,desc] lists.
 
     print(len(godb),len(qdb),len(qnames),len(frq),len(terms))
     with open(out,'wb') as f:
-        dump([godb,frq,terms],f)
+        dump(goTables(godb,frq,terms),f)
 
 
 @click.command()
@@ -201,13 +240,12 @@ It will create an output file that contains [go,freq,desc] lists.
 @click.argument('out', type=click.Path(exists=False,file_okay=True,dir_okay=False))
 def mkcache(test, fasta, prdb, out):
     '''mkcache command gets a fasta file and a PROST database to create a cache file.
-Cache files are dictionary which consist of amino acid sequence keys and PROST embedding values.
+Cache files are SQLite databases that map amino acid sequences to PROST embeddings, copy it to PROSTDIR/cache.sqlite to use it with makedb.
 This command should be run on unparsed PROST databases (no parseUniprotNames)'''
     from random import sample
     from pyprost import quantSeq
     prdbdict = {}
-    with open(prdb,'rb') as f:
-        qnames,qdb = loads(blosc.decompress(f.read()))
+    qnames,qdb = loadDB(prdb)
     for i,n in enumerate(qnames):
         prdbdict[n] = qdb[i]
 
@@ -225,8 +263,9 @@ This command should be run on unparsed PROST databases (no parseUniprotNames)'''
         seq[name] = fa[1]
         seq2.append(fa[1])
 
-    with open(out,'wb') as f:
-        dump(cache,f)
+    from pyprost.cache import EmbeddingCache
+    with EmbeddingCache(out) as c:
+        c.update(cache)
 
     print('PROST db size:',len(qdb),'cache size:',len(cache.keys()),'unique seq size',len(set(seq2)))
     if test:
@@ -252,188 +291,868 @@ parseUniprotNames commend gets a PROST database file and parses the names by:
 and saves upated PROST database to out argument.'''
     import re
 
-    with open(prdb,'rb') as f:
-        qnames,qdb = loads(blosc.decompress(f.read()))
+    qnames,qdb = loadDB(prdb)
     names = np.empty(len(qnames),dtype=object)
     for i,name in enumerate(qnames):
         names[i] = parseName(name)
 
     print(len(names),names[0],names[-1])
 
-    with open(out,'wb') as f:
-        f.write(blosc.compress(dumps([names,qdb])))
-@click.command()
-@click.option('-n', '--no-cache', is_flag=True, default=False, help='Disable embedding caching')
-@click.option('-s', '--split', default=0, type=int, help='Split output into files of specified size (0 for no split)')
-@click.argument('fasta', type=click.Path(exists=True,file_okay=True,dir_okay=False))
-@click.argument('out', type=click.Path(exists=False,file_okay=True,dir_okay=False))
-def makedb(no_cache, split, fasta, out):
-    '''makedb command creates PROST databases from FASTA files.
-makedb command gets a fasta file and creates a PROST database that can be used as query or target database in a search.'''
-    from pyprost import quantSeq
-
-    cache = {}
-    cacheDirty = False
-    file_ind = 0
-
-    if not no_cache:
-        if os.path.exists(prostdir+'/cache.pkl'):
-            with open(prostdir+'/cache.pkl','rb') as f:
-                cache = load(f)
-
-    quant = []
-    namesd = {}
-    ind = 0
-
-    for fa in fasta_iter(fasta):
-        name = fa[0]
+    saveDB(out,names,qdb)
+class _NameDigests:
+    #set of 8 byte name digests kept in sorted arrays, about 8 bytes per name.
+    #Blocks are added at once and arrays of similar size are merged, so there
+    #are at most log2(names) arrays to search. Two of 10^9 different names
+    #share a digest with a probability of about 3%.
+    def __init__(self, digests=()):
+        digests = np.unique(np.asarray(digests,dtype=np.uint64))
+        self.levels = [digests] if len(digests) > 0 else []
+
+    @staticmethod
+    def digest(name):
+        from hashlib import blake2b
+        return int.from_bytes(blake2b(name.encode(),digest_size=8).digest(),'little')
+
+    def add(self, digests):
+        #adds a block of digests, returns a mask of the ones that were not seen before
+        digests = np.asarray(digests,dtype=np.uint64)
+        new = np.zeros(len(digests),dtype=bool)
+        new[np.unique(digests,return_index=True)[1]] = True
+        for level in self.levels:
+            i = np.minimum(np.searchsorted(level,digests),len(level)-1)
+            new &= level[i] != digests
+        block = np.sort(digests[new])
+        if len(block) == 0: return new
+        while len(self.levels) > 0 and len(self.levels[-1]) <= 2*len(block):
+            block = np.sort(np.concatenate([self.levels.pop(),block]))
+        self.levels.append(block)
+        return new
+
+def _fastaRecords(fasta, offset=0):
+    #fasta_iter from a byte offset, yields (name, sequence, offset after the record)
+    with open(fasta,'rb') as fh:
+        fh.seek(offset)
+        name,seq = None,[]
+        for line in fh:
+            if line[:1] == b'>':
+                if name is not None: yield name,''.join(seq),offset
+                name,seq = line[1:].decode().strip(),[]
+            elif name is not None: seq.append(line.decode().strip())
+            offset += len(line)
+        if name is not None: yield name,''.join(seq),offset
+
+def _validRecords(fasta, offset=0, seen=None, ends=None, block=4096):
+    #yields the (name, sequence) records of a fasta file that can be embedded.
+    #Reading starts at the byte offset, names in seen are skipped as duplicates.
+    #The offset after every yielded record is appended to ends.
+    seen = _NameDigests() if seen is None else seen
+    valid = []
+
+    def unique():
+        new = seen.add([_NameDigests.digest(name) for name,_,_ in valid])
+        for (name,seq,end),isNew in zip(valid,new):
+            if not isNew:
+                print(name,'is already exits!')
+                continue
+            if ends is not None: ends.append(end)
+            yield name,seq
+        valid.clear()
 
-        l = len(fa[1])
+    for name,seq,end in _fastaRecords(fasta,offset):
+        l = len(seq)
         if l < 5:
             print(name,'discarded, length:',l)
             continue
 
-        status,offchar = check_seq(fa[1])
+        status,offchar = check_seq(seq)
         if status == False:
             print(name,'contains unknown aa',offchar)
             continue
 
-        if name in namesd:
-            print(name,'is already exits!')
-            assert np.shape(quant[namesd[name]])[0] == 475
-            continue
-
-        namesd[name] = ind
-        ind += 1
+        valid.append((name,seq,end))
+        if len(valid) >= block: yield from unique()
+    yield from unique()
 
-        if fa[1] in cache:
-            quant.append(cache[fa[1]])
+def _quantWorkerInit(threads, runtime='fp32', profile=None, pool=False):
+    #every worker loads the model once with its share of the threads.
+    #A pool respawns workers whose initializer raises forever, so in a pool
+    #the error is kept and raised by every task instead.
+    try:
+        import torch
+        from pyprost.esmts25_13 import _load,setRuntime
+        _profileStart(profile,'makedb-worker')
+        setRuntime(runtime)
+        #the ONNX Runtime session takes its thread count when it is created
+        _load(threads)
+        if threads > 0: torch.set_num_threads(threads)
+    except Exception as e:
+        if not pool: raise
+        _shared['error'] = e
+
+def _quantTask(seqs, batch_tokens, overlap=0):
+    #returns the quantizations and the seconds spent embedding and quantizing them
+    if 'error' in _shared: raise _shared['error']
+    from pyprost.esmts25_13 import embed,embedBatch
+    from pyprost.prosttools import quantEmbBatch
+    seqs = [seq.upper() for seq in seqs]
+    t = time.perf_counter()
+    if batch_tokens > 0: embs = embedBatch(seqs,batch_tokens,overlap)
+    else: embs = [embed(seq,overlap) for seq in seqs]
+    t1 = time.perf_counter()
+    quants = quantEmbBatch(embs)
+    from multiprocessing import parent_process
+    if parent_process() is not None: _profileDump()
+    return quants,{'embed':t1-t,'quantize':time.perf_counter()-t1}
+
+def _quantRecords(records, cache, batch_tokens, pool=None, jobs=1, overlap=0):
+    #yields (name, seq, quantization, cached) in input order.
+    #The embedding and quantization times of the tasks are added to _stats.
+    #Uncached sequences are quantized in tasks that run here or in the worker pool.
+    #The cache holds quantizations of long sequences embedded without overlap,
+    #so with overlap they are neither looked up nor stored.
+    #With batch_tokens uncached sequences are collected into a window of 256
+    #batches so that equal length sequences can be embedded together.
+    queue = deque()   #[name, seq, quantization, cached], quantization is None until its task finished
+    window = []       #queue entries that are not sent to a task yet
+    windowTokens = 0
+    tasks = deque()   #(queue entries, AsyncResult)
+
+    def cacheable(seq):
+        return overlap <= 0 or len(seq) <= 1022
+
+    def finish(entries, result):
+        quants,times = result
+        _addStats(_stats,times)
+        cache.update({e[1]:q for e,q in zip(entries,quants) if cacheable(e[1])})
+        for e,q in zip(entries,quants): e[2] = q
+
+    def submit(entries):
+        seqs = [e[1] for e in entries]
+        if pool is None: finish(entries,_quantTask(seqs,batch_tokens,overlap))
+        else: tasks.append((entries,pool.apply_async(_quantTask,(seqs,batch_tokens,overlap))))
+
+    def flushWindow():
+        if len(window) == 0: return
+        if batch_tokens <= 0:
+            for e in window: submit([e])
         else:
-            print(name,'not found in cache. Quantize it.')
-            qseq = quantSeq(fa[1])
-            quant.append(qseq)
-            cache[fa[1]] = qseq
-            cacheDirty = True
-
-        assert np.shape(quant[-1])[0] == 475
-
-        if split > 0 and len(quant) >= split:
-            split_names = list(namesd.keys())[-split:]
-            split_quant = quant[-split:]
-            split_filename = f"{os.path.splitext(out)[0]}_{file_ind}.prdb"
-            with open(split_filename, 'wb') as f:
-                f.write(blosc.compress(dumps([np.array(split_names), np.array(split_quant)])))
-            print(f'Written split file: {split_filename} with {len(split_names)} entries')
-            quant = quant[:-split]
-            file_ind += 1
-
-    if len(quant) > 0:
-        final_filename = f"{os.path.splitext(out)[0]}_{file_ind}.prdb" if split > 0 else out
-        with open(final_filename, 'wb') as f:
-            f.write(blosc.compress(dumps([np.array(list(namesd.keys())[-len(quant):]), np.array(quant)])))
-        print(f'Written {"final " if split > 0 else ""}file: {final_filename} with {len(quant)} entries')
-
-    if not no_cache and cacheDirty:
-        with open(prostdir+'/cache.pkl','wb') as f:
-            dump(cache,f)
+            print(f'Quantize {len(window)} sequences in batches.')
+            #sorting keeps equal length sequences in the same task
+            window.sort(key=lambda e: len(e[1]))
+            chunk = max(batch_tokens,windowTokens//(4*jobs))
+            start,tokens = 0,0
+            for i,e in enumerate(window):
+                tokens += len(e[1])
+                if tokens >= chunk or i == len(window)-1:
+                    submit(window[start:i+1])
+                    start,tokens = i+1,0
+        window.clear()
+
+    def collect(block):
+        while len(tasks) > 0 and (block or tasks[0][1].ready()):
+            entries,task = tasks.popleft()
+            finish(entries,task.get())
+            block = False
+
+    for name,seq in records:
+        with _timed('cache'): q = cache.get(seq) if cacheable(seq) else None
+        entry = [name,seq,q,q is not None]
+        queue.append(entry)
+        if q is None:
+            window.append(entry)
+            windowTokens += len(seq)
+        #cached entries count towards the bound too, a single uncached entry
+        #must not hold back everything read after it
+        if batch_tokens <= 0 or windowTokens >= batch_tokens*256 or len(queue) >= 65536:
+            flushWindow()
+            windowTokens = 0
+        collect(False)
+        #bound the number of tasks in flight and the entries waiting for them
+        while len(tasks) > 2*jobs or len(queue) >= 65536 and len(tasks) > 0:
+            collect(True)
+        while len(queue) > 0 and queue[0][2] is not None:
+            yield tuple(queue.popleft())
+    flushWindow()
+    while len(tasks) > 0: collect(True)
+    while len(queue) > 0:
+        yield tuple(queue.popleft())
+
+def _resumeWriter(out, split, bits=None):
+    #opens the output of an interrupted makedb run.
+    #returns the writer to continue with, its file name, shard index and the number of committed entries
+    if split <= 0:
+        if not os.path.exists(out): return None,out,0,0
+        writer = PrdbWriter(out,'a',sync=True,bits=bits)
+        return writer,out,0,writer.count
+    base = os.path.splitext(out)[0]
+    shards = []
+    while os.path.exists(f"{base}_{len(shards)}.prdb"):
+        shards.append(f"{base}_{len(shards)}.prdb")
+    if len(shards) == 0: return None,out,0,0
+    done = sum(ProstDB(shard).count for shard in shards[:-1])
+    writer = PrdbWriter(shards[-1],'a',sync=True,bits=bits)
+    done += writer.count
+    if writer.count >= split:
+        writer.close()
+        return None,shards[-1],len(shards),done
+    return writer,shards[-1],len(shards)-1,done
+
+class _MakedbState:
+    #where the committed entries of a makedb run end in its FASTA file and the
+    #digests of their names, so --resume seeks to the next record instead of reading
+    #everything before it again. out.resume holds the JSON {fasta, count, offset},
+    #out.names the digests in entry order, both are removed when the run completes.
+    def __init__(self, out, fasta, count=0, offset=0):
+        self.path,self.fasta = out+'.resume',os.path.abspath(fasta)
+        self.count,self.offset = count,offset
+        with open(out+'.names','ab') as f: f.truncate(count*8)
+        self.names = open(out+'.names','ab')
+        self.pending = []
+
+    @staticmethod
+    def load(out, fasta):
+        #(count, offset, digests) of the last commit, None without a state of this fasta file
+        try:
+            with open(out+'.resume') as f: state = json.load(f)
+        except (OSError,ValueError): return None
+        if state.get('fasta') != os.path.abspath(fasta): return None
+        digests = np.fromfile(out+'.names',dtype='<u8',count=state['count'])
+        if len(digests) != state['count']: return None
+        return state['count'],state['offset'],digests
+
+    def append(self, name, end):
+        self.pending.append((_NameDigests.digest(name),end))
+
+    def commit(self):
+        #called after the writer commit, an interrupted commit leaves count behind the output
+        if len(self.pending) == 0: return
+        self.names.write(np.array([d for d,_ in self.pending],dtype='<u8').tobytes())
+        self.names.flush()
+        os.fsync(self.names.fileno())
+        self.count,self.offset = self.count+len(self.pending),self.pending[-1][1]
+        self.pending = []
+        with open(self.path+'.tmp','w') as f:
+            json.dump({'fasta':self.fasta,'count':self.count,'offset':self.offset},f)
+        os.replace(self.path+'.tmp',self.path)
+
+    def remove(self):
+        self.names.close()
+        for path in [self.path,self.names.name]:
+            if os.path.exists(path): os.remove(path)
+
+def _openCache(maxEntries=0, runtime='fp32'):
+    #the embedding cache used to be a pickled dictionary, import it on first use.
+    #Other runtimes than fp32 give slightly different quantizations and have their own cache.
+    from pyprost import _init_prost_files
+    from pyprost.cache import EmbeddingCache
+    _init_prost_files()
+    if runtime != 'fp32': return EmbeddingCache(f'{prostdir}/cache.{runtime}.sqlite',maxEntries)
+    path = prostdir+'/cache.sqlite'
+    if not os.path.exists(path) and os.path.exists(prostdir+'/cache.pkl'):
+        print('Import cache.pkl into the on disk cache, this is done only once.')
+        with EmbeddingCache(path+'.tmp') as cache:
+            cache.importPickle(prostdir+'/cache.pkl')
+        os.replace(path+'.tmp',path)
+    return EmbeddingCache(path,maxEntries)
+
+@click.command()
+@click.option('-n', '--no-cache', is_flag=True, default=False, help='Disable embedding caching')
+@click.option('-s', '--split', default=0, type=int, help='Split output into files of specified size (0 for no split)')
+@click.option('-b', '--batch-tokens', default=0, type=int, help='Embed equal length sequences together in batches of this many tokens (0 for one sequence at a time)')
+@click.option('-r', '--resume', is_flag=True, default=False, help='Continue an interrupted run, entries already in the output are skipped')
+@click.option('-c', '--checkpoint', default=300, type=int, help='Seconds between checkpoints of the output')
+@click.option('--cache-size', default=0, type=int, help='Keep at most this many entries in the embedding cache, least recently used ones are evicted (0 for no limit)')
+@click.option('-j', '--jobs', default=1, type=int, help='Number of embedding processes, each loads its own copy of the model')
+@click.option('-t', '--threads-per-job', default=0, type=int, help='Torch threads of each embedding process (0 for cpu count / jobs)')
+@click.option('--bits', default=8, type=click.Choice(['4','6','8']), help='Store quantizations as packed 4 or 6 bit codes to reduce memory')
+@click.option('--overlap', default=0, type=int, help='Embed longer than 1022 residue sequences in windows that overlap by this many residues (0 for contiguous pieces)')
+@click.option('--runtime', default='fp32', type=click.Choice(['fp32','bf16','int8','onnx']), help='How the model is run, check the accuracy of other runtimes than fp32 with checkruntime')
+@click.option('--progress', default=10, type=int, help='Seconds between progress lines (0 for none)')
+@click.option('--stats', default=None, type=click.Path(exists=False,file_okay=True,dir_okay=False), help='Write the JSON summary of counters and timers to this file instead of stdout')
+@click.option('--profile', default=None, type=click.Path(exists=False,file_okay=False,dir_okay=True), help='Write a cProfile file of every process into this directory')
+@click.argument('fasta', type=click.Path(exists=True,file_okay=True,dir_okay=False))
+@click.argument('out', type=click.Path(exists=False,file_okay=True,dir_okay=False))
+def makedb(no_cache, split, batch_tokens, resume, checkpoint, cache_size, jobs, threads_per_job, bits, overlap, runtime, progress, stats, profile, fasta, out):
+    '''makedb command creates PROST databases from FASTA files.
+makedb command gets a fasta file and creates a PROST database that can be used as query or target database in a search.
+Entries are written to the database as they are quantized, the database can be read while it is growing.
+With --batch-tokens uncached sequences are collected and sequences with the same length are embedded together.
+The output is checkpointed periodically, an interrupted run can be continued with --resume.
+Quantizations are cached on disk in PROSTDIR/cache.sqlite, new entries are stored as soon as they are computed.
+With --jobs sequences are embedded by several processes and written in input order.
+With --bits 4 or 6 the database stores packed codes, which are searched directly
+and take half or three quarters of the memory of the default 8 bit quantizations.
+With --runtime bf16, int8 or onnx the model runs in a faster but less exact mode.
+Progress is printed every --progress seconds. At the end a JSON summary with the cache hit
+rate and the embedding and quantization time per residue is printed or written to --stats.
+--profile DIR writes DIR/makedb-*-PID.prof cProfile files.'''
+    from pyprost.esmts25_13 import setRuntime
+    _profileStart(profile,'makedb-main')
+    bits = int(bits)
+    setRuntime(runtime)
+    cache = {} if no_cache else _openCache(cache_size,runtime)
+    file_ind = 0
+
+    pool = None
+    threads = threads_per_job if threads_per_job > 0 else max(1,cpu_count()//jobs)
+    if jobs > 1:
+        #spawn, torch thread pools do not survive a fork
+        pool = get_context('spawn').Pool(jobs,initializer=_quantWorkerInit,initargs=(threads,runtime,profile,True))
+    elif threads_per_job > 0: _quantWorkerInit(threads,runtime)
+    sequences,quantized,residues = 0,0,0
+    start = lastProgress = time.time()
+
+    writer = None
+    filename = out
+    done,count,offset,digests = 0,0,0,[]
+    if resume:
+        try: writer,filename,file_ind,done = _resumeWriter(out,split,bits)
+        except ValueError as e: raise click.ClickException(str(e))
+        if done > 0: print(f'Resuming after {done} entries.')
+        saved = _MakedbState.load(out,fasta)
+        #the state can lag behind the output by the entries of an interrupted commit
+        if saved is not None and saved[0] <= done: count,offset,digests = saved
+    ends = deque()
+    seen = _NameDigests(digests)
+    records = _validRecords(fasta,offset,seen,ends)
+    state = _MakedbState(out,fasta,count,offset)
+    #entries in the output past the saved state are read again and skipped
+    for name,_ in islice(records,done-count): state.append(name,ends.popleft())
+    state.commit()
+    complete = False
+
+    lastCheckpoint = time.time()
+    try:
+        for name,seq,q,cached in _quantRecords(records,cache,batch_tokens,pool,jobs,overlap):
+            assert np.shape(q)[0] == 475
+            sequences += 1
+            if not cached:
+                quantized += 1
+                residues += len(seq)
+            if progress > 0 and time.time()-lastProgress >= progress:
+                elapsed = time.time()-start
+                _printProgress('Processed',sequences,None,elapsed,f', {sequences-quantized} cached, {residues/elapsed:.0f} residues/s')
+                lastProgress = time.time()
+            t = time.perf_counter()
+            if writer is None:
+                if split > 0: filename = f"{os.path.splitext(out)[0]}_{file_ind}.prdb"
+                writer = PrdbWriter(filename,capacity=split if split > 0 else 1024,sync=True,bits=bits)
+            writer.append(name,q)
+            state.append(name,ends.popleft())
+
+            if split > 0 and writer.count+writer.pending >= split:
+                writer.close()
+                state.commit()
+                print(f'Written split file: {filename} with {writer.count} entries')
+                writer = None
+                file_ind += 1
+
+            if time.time()-lastCheckpoint >= checkpoint:
+                if writer is not None: writer.commit()
+                state.commit()
+                if not no_cache: cache.flush()
+                lastCheckpoint = time.time()
+            elif writer is not None and writer.pending >= 1000:
+                writer.commit()
+                state.commit()
+            _count('write',time.perf_counter()-t)
+        complete = True
+    finally:
+        if writer is not None:
+            writer.close()
+            print(f'Written {"final " if split > 0 else ""}file: {filename} with {writer.count} entries')
+        state.commit()
+        if complete: state.remove()
+
+        if not no_cache: cache.close()
+        if pool is not None: pool.terminate()
+        elapsed = time.time()-start
+        if quantized > 0:
+            print(f'Quantized {quantized} sequences ({residues} residues) in {elapsed:.1f}s with {jobs} jobs x {threads} threads, '
+                  f'{quantized/elapsed:.2f} sequences/s, {residues/elapsed:.0f} residues/s')
+        _profileDump(stop=True)
+        #embed and quantize are summed over the jobs
+        _writeSummary({'command':'makedb','sequences':sequences,'cached':sequences-quantized,
+                       'cache_hit_rate':(sequences-quantized)/max(sequences,1),'quantized':quantized,'residues':residues,
+                       'jobs':jobs,'threads':threads,'elapsed':elapsed,'residues_per_second':residues/max(elapsed,1e-9),
+                       'embed_seconds_per_residue':_stats.get('embed',0)/max(residues,1),
+                       'quantize_seconds_per_residue':_stats.get('quantize',0)/max(residues,1),'totals':_takeStats()},stats)
+
+def _allHits(quants, thr):
+    #{target: e-value} of the hits of every entry searched against all entries
+    hits = []
+    for dbdiff in l1Distances(quants,quants):
+        m,mad = medianMAD(dbdiff)
+        res,e = _hits(dbdiff,m,mad*1.4826,len(quants),thr)
+        hits.append(dict(zip(res.tolist(),e.tolist())))
+    return hits
 
 @click.command()
+@click.option('--runtime', 'runtimes', default='bf16,int8,onnx', help='Comma separated runtimes to compare with fp32')
+@click.option('--thr', default=0.05, help='E-value threshold of a hit')
+@click.option('-b', '--batch-tokens', default=4096, type=int, help='Embed equal length sequences together in batches of this many tokens')
+@click.option('--limit', default=1000, help='Use at most this many sequences of the FASTA file')
+@click.argument('fasta', type=click.Path(exists=True,file_okay=True,dir_okay=False))
+def checkruntime(runtimes, thr, batch_tokens, limit, fasta):
+    '''Measures the speed and accuracy of the makedb runtimes against fp32.
+The sequences of the FASTA file are quantized with fp32 and with every runtime, bypassing the cache,
+and searched against each other. One JSON line is printed for every runtime with the residues/s,
+the prostDistance between the fp32 and the runtime quantization of each sequence, and the recall,
+precision and e-value differences of the all against all hits compared with fp32.'''
+    from pyprost import quantSeqBatch
+    from pyprost.esmts25_13 import setRuntime
+    seqs = [seq for _,seq in islice(_validRecords(fasta),limit)]
+    if len(seqs) < 2: raise click.ClickException('At least two sequences are needed.')
+    residues = sum(len(seq) for seq in seqs)
+
+    def quantize(runtime):
+        setRuntime(runtime)
+        quantSeqBatch(seqs[:1],batch_tokens)   #load the model outside of the timing
+        start = time.time()
+        quants = quantSeqBatch(seqs,batch_tokens)
+        return quants,time.time()-start
+
+    base,baseTime = quantize('fp32')
+    baseHits = _allHits(base,thr)
+    nhits = sum(len(h) for h in baseHits)
+    scale = np.median(l1Distances(base,base))/2
+    for runtime in runtimes.split(','):
+        try: quants,elapsed = quantize(runtime)
+        except Exception as e:
+            click.echo(json.dumps({'runtime':runtime,'error':str(e)}))
+            continue
+        drift = np.abs(base.astype(np.int16)-quants).sum(axis=1)/2
+        hits = _allHits(quants,thr)
+        found = sum(len(h.keys() & b.keys()) for h,b in zip(hits,baseHits))
+        logdiff = [abs(np.log10(max(h[t],1e-300))-np.log10(max(b[t],1e-300))) for h,b in zip(hits,baseHits) for t in h.keys() & b.keys()]
+        click.echo(json.dumps({'runtime':runtime,'sequences':len(seqs),'residues_per_second':residues/elapsed,
+                               'speedup':baseTime/elapsed,'distance_drift_mean':float(drift.mean()),
+                               'distance_drift_max':float(drift.max()),'relative_drift':float(drift.mean()/scale),
+                               'hits':nhits,'recall':found/max(nhits,1),'precision':found/max(sum(len(h) for h in hits),1),
+                               'evalue_log10_median_difference':float(np.median(logdiff)) if logdiff else 0.0}))
+
+def _newEntries(names, quants, seenNames, seenQuants, newNames, newQuants):
+    #mask of the entries whose name and quantization are neither in the seen
+    #nor in the new sets, the kept entries are added to the new sets
+    import hashlib
+    keep = np.ones(len(names),dtype=bool)
+    for j,name in enumerate(names):
+        if seenNames is not None and (name in seenNames or name in newNames): keep[j] = False
+        key = None
+        if keep[j] and seenQuants is not None:
+            key = hashlib.blake2b(quants[j].tobytes(),digest_size=16).digest()
+            if key in seenQuants or key in newQuants: keep[j] = False
+        if not keep[j]: continue
+        if seenNames is not None: newNames.add(name)
+        if key is not None: newQuants.add(key)
+    return keep
+
+@click.command()
+@click.option('--append', is_flag=True, default=False, help='Add the inputs to an existing output database instead of rewriting it')
+@click.option('--dedupe', multiple=True, type=click.Choice(['name','quant']), help='Skip entries with an already merged name or quantization, can be given twice')
 @click.argument('input_files', nargs=-1, type=click.Path(exists=True))
 @click.argument('output_file', type=click.Path(exists=False))
-def mergedbs(input_files, output_file):
+def mergedbs(append, dedupe, input_files, output_file):
     """Merges multiple PROST databases into one.
 
+    Entries are copied in chunks, the inputs are never held in memory as a whole.
+    With --append the entries of the existing output are kept and not rewritten.
+
     Args:
         input_files: List of input PROST databases
         output_file: Path to write combined database
     """
-    all_names = []
-    all_quant = []
-
-    for file in input_files:
-        try:
-            with open(file, 'rb') as f:
-                names, db = loads(blosc.decompress(f.read()))
-                all_names.extend(names)
-                all_quant.extend(db)
-                print(f"Processing {file}, number of entries: {len(db)}")
-        except Exception as e:
-            print(f"Error processing {file}: {str(e)}", err=True)
-            continue
+    chunk = 65536
+    if append and os.path.exists(output_file) and any(os.path.samefile(f,output_file) for f in input_files):
+        raise click.ClickException(f'{output_file} can not be appended to itself')
+    #a new output is written next to output_file and replaces it at the end,
+    #so output_file can be one of the inputs
+    path = output_file if append else f'{output_file}.{os.getpid()}.tmp'
+    try:
+        if append: writer = PrdbWriter(path,'a')
+        else: writer = PrdbWriter(path,capacity=sum(len(ProstDB(f)) for f in input_files if isPrdb2(f)))
+    except ValueError as e:
+        raise click.ClickException(f'{e}, convert it with `prost.py convertdb` before appending')
+    seenNames = set() if 'name' in dedupe else None
+    seenQuants = set() if 'quant' in dedupe else None
+    existing,skipped = writer.count,0
+    if existing > 0 and len(dedupe) > 0:
+        names, db = loadDB(output_file)
+        for i in range(0,existing,chunk):
+            _newEntries(names[i:i+chunk],np.asarray(db[i:i+chunk]),seenNames,seenQuants,seenNames,seenQuants)
 
     try:
-        with open(output_file, 'wb') as f:
-            combined = blosc.compress(dumps([np.array(all_names), np.array(all_quant)]))
-            f.write(combined)
-        print(f"Successfully combined {len(input_files)} files into {output_file} with {len(all_quant)} entries.")
-    except Exception as e:
-        print(f"Error writing output file: {str(e)}", err=True)
-
-def _search_worker(thr, gothr, qnames,qdb,tnames,tdb, go,goFrq,goDesc, mem, taskInd, n):
-    lqdb = len(qdb)
-    ldb = len(tdb)
-    start = int(lqdb/n*taskInd)
-    stop = int(lqdb/n*(taskInd+1))
-    if stop > lqdb: stop = lqdb
-    #print(taskInd,n,start,stop)
-    homologList, goList = {},{}
-    for i,q in enumerate(qdb[start:stop]):
-        qname = parseName(qnames[i+start])[0]
-        goList[qname] = []
-        homologList[qname] = []
-        print(f'[{taskInd:02d}] Searching for {qname}')
-        np.subtract(tdb,q,out=mem)
-        np.absolute(mem,out=mem)
-        dbdiff = mem.sum(axis=1)
-        m=np.median(dbdiff)
-        s=st.median_abs_deviation(dbdiff)*1.4826
-        zscore = (dbdiff-m)/s
-        e = st.norm.cdf(zscore)*ldb
-        res = np.where(e < thr)[0]
-        sort = np.argsort(e[res])
-        res = res[sort]
-        dbdiff = dbdiff[res]/2
-        evals = e[res]
-        names = tnames[res]
-
-        if go is not None:
-            res2 = np.where(e < gothr)[0]
-            sort2 = np.argsort(e[res2])
-            res2 = res2[sort2]
-            for a in annotate(res2,e[res2],go,goFrq,goDesc):
-                goList[qname].append([a[0], a[1], f'{a[2]:.3f}', parseName(tnames[a[3]])[0], a[5], f'{a[4]:.2e}'])
-
-        for n,diff,ev in zip(names,dbdiff,evals):
-            n = parseName(n)
-            homologList[qname].append([n[0], n[1], n[2], n[3], diff, f'{ev:.2e}'])
-    return goList,homologList
-def _search(thr, gothr, querydb, targetdb, godb,n):
+        with writer:
+            for file in input_files:
+                #the keys of a file join the seen sets only once it is committed,
+                #the entries of a rolled back file may be merged from a later one
+                newNames = set() if seenNames is not None else None
+                newQuants = set() if seenQuants is not None else None
+                fileSkipped = 0
+                try:
+                    names, db = loadDB(file)
+                    if len(names) > 0 and writer.parsed is not None and (type(names[0]) == tuple) != writer.parsed:
+                        raise ValueError('its names are not in the format of the output database')
+                    for i in range(0,len(db),chunk):
+                        n,q = names[i:i+chunk],np.asarray(db[i:i+chunk])
+                        if len(dedupe) > 0:
+                            keep = _newEntries(n,q,seenNames,seenQuants,newNames,newQuants)
+                            n,q = [name for name,k in zip(n,keep) if k],q[keep]
+                            fileSkipped += len(keep)-len(q)
+                        writer.extend(n,q)
+                    writer.commit()
+                    if seenNames is not None: seenNames |= newNames
+                    if seenQuants is not None: seenQuants |= newQuants
+                    skipped += fileSkipped
+                    print(f"Processing {file}, number of entries: {len(db)}")
+                except Exception as e:
+                    writer.rollback()
+                    click.echo(f"Error processing {file}: {str(e)}", err=True)
+                    continue
+
+        if not append: os.replace(path,output_file)
+    finally:
+        if not append and os.path.exists(path): os.remove(path)
+
+    if skipped > 0: print(f"Skipped {skipped} duplicate entries.")
+    print(f"Successfully combined {len(input_files)} files into {output_file} with {writer.count} entries ({writer.count-existing} new).")
+
+@click.command()
+@click.option('--bits', default=8, type=click.Choice(['4','6','8']), help='Store quantizations as packed 4 or 6 bit codes')
+@click.argument('prdb', type=click.Path(exists=True,file_okay=True,dir_okay=False))
+@click.argument('out', type=click.Path(exists=False,file_okay=True,dir_okay=False))
+def convertdb(bits, prdb, out):
+    '''Converts a PROST database into the memory mapped v2 format.
+Older PROST databases are blosc compressed pickles that have to be fully loaded before a search.
+v2 databases are opened instantly and their names are only read for reported hits.
+With --bits a database is converted into packed codes, see makedb.'''
+    n = convertDB(prdb,out,bits=int(bits))
+    print(f'Converted {prdb} into {out} with {n} entries.')
+
+_shared = {}
+_stats = {}   #counters and seconds of this process, workers send them back with every task
+
+def _count(key, value=1):
+    _stats[key] = _stats.get(key,0)+value
+
+@contextmanager
+def _timed(key):
+    #adds the seconds spent in the block to _stats[key]
+    t = time.perf_counter()
+    try: yield
+    finally: _count(key,time.perf_counter()-t)
+
+def _takeStats():
+    #counters and timers since the last call
+    stats = dict(_stats)
+    _stats.clear()
+    return stats
+
+def _addStats(total, stats):
+    for k,v in stats.items(): total[k] = total.get(k,0)+v
+
+def _profileStart(profile, name):
+    #profiles this process with cProfile into profile/name-pid.prof
+    if profile is None: return
+    import cProfile
+    #forked workers inherit the profiler of the main process
+    if _shared.get('profile') is not None: _shared['profile'][0].disable()
+    os.makedirs(profile,exist_ok=True)
+    _shared['profile'] = (cProfile.Profile(),f'{profile}/{name}-{os.getpid()}.prof')
+    _shared['profile'][0].enable()
+
+def _profileDump(stop=False):
+    #pool workers are terminated without cleanup, so they write their profile after every task
+    if _shared.get('profile') is None: return
+    prof,path = _shared['profile']
+    prof.dump_stats(path)
+    if stop: _shared['profile'] = None
+    else: prof.enable()
+
+def _writeSummary(summary, path):
+    #the final JSON summary goes to path or, without path, to stdout as one line
+    if path is None: print(json.dumps(summary))
+    else:
+        with open(path,'w') as f:
+            json.dump(summary,f,indent=1)
+def _search_init(querydb, targetdb, go, index=None, nprobe=32, keep=0, profile=None):
+    #runs once in every worker. Databases are memory mapped v2 files so all
+    #workers share the same pages, GO tables are memory mapped npy files.
+    #targetdb is a list of paths for a sharded target database.
+    #Nothing may raise here, Pool replaces a failed worker with a new one forever,
+    #the arguments are checked by _prepareTargets.
+    _stats.clear()   #forked workers inherit the counters of the main process
+    _profileStart(profile,'search-worker')
+    t = time.perf_counter()
+    import scipy.special   #imported by _hits, its import takes a while and counts as load
+    if querydb is not None: _shared['q'] = loadDB(querydb)
+    if type(targetdb) == list:
+        shards = [ProstDB(path) for path in targetdb]
+        _shared['t'] = (ShardedNames([p.names for p in shards]),[p.db for p in shards])
+    else: _shared['t'] = loadDB(targetdb)
+    _shared['keep'] = keep
+    _shared['index'] = None
+    if index is not None:
+        from pyprost.index import loadIndex
+        index = loadIndex(index)
+        #targets that estimate the distance distribution of a query
+        _shared['index'] = (index,nprobe,_shared['t'][1][index['null']])
+    if go is not None:
+        go = dict(go)
+        for k in ('indptr','indices','freq'):
+            go[k] = np.load(go[k],mmap_mode='r')
+    _shared['go'] = go
+    _count('load',time.perf_counter()-t)
+
+@click.command()
+@click.option('--nlist', default=0, type=int, help='Number of clusters (0 for 4*sqrt(database size))')
+@click.option('--iters', default=10, type=int, help='Number of k-means iterations')
+@click.argument('prdb', type=click.Path(exists=True,file_okay=True,dir_okay=False))
+@click.argument('out', type=click.Path(exists=False,file_okay=True,dir_okay=False))
+def mkindex(nlist, iters, prdb, out):
+    '''Creates a prefilter index for searching large target databases.
+The index clusters the target database, `search --index` then scores only the targets in the clusters closest to a query.
+E-values are calibrated with the distances to a random sample of the database that is stored in the index.'''
+    from pyprost.index import buildIndex,saveIndex
+    _,db = loadDB(prdb)
+    index = buildIndex(db,nlist,iters)
+    saveIndex(out,index)
+    print(f'Written index {out} with {len(index["centroids"])} clusters for {len(db)} entries.')
+
+def _closest(dists, ids, k):
+    #positions of the k smallest (distance, id) pairs, unordered
+    if len(dists) <= k: return np.arange(len(dists))
+    kth = np.partition(dists,k-1)[k-1]
+    below = np.nonzero(dists < kth)[0]
+    tied = np.nonzero(dists == kth)[0]
+    tied = tied[np.argsort(ids[tied],kind='stable')[:k-len(below)]]
+    return np.concatenate([below,tied])
+
+def _hits(dbdiff, m, s, ldb, thr, k=0):
+    #targets with an e-value below thr sorted by e-value, at most k of them if k > 0.
+    #The e-value grows with the distance, so thr is turned into a distance cutoff
+    #and the normal CDF is only evaluated for the targets below it. With k the
+    #k closest of them are selected first and only their e-values are computed.
+    #dbdiff is in target id order, so of targets tied in distance or e-value
+    #the ones with smaller ids are selected and reported first.
+    from scipy.special import ndtr,ndtri
+    if s > 0: res = np.nonzero(dbdiff <= m+s*ndtri(min(thr/ldb,1.0))+0.5)[0]
+    else: res = np.arange(len(dbdiff))
+    if 0 < k < len(res): res = np.sort(res[_closest(dbdiff[res],res,k)])
+    e = ndtr((dbdiff[res]-m)/s)*ldb
+    keep = e < thr
+    res,e = res[keep],e[keep]
+    order = np.argsort(e,kind='stable') if k > 0 else np.argsort(e)
+    return res[order],e[order]
+
+def _searchQueries(thr, gothr, start, stop, taskInd, k=0):
+    #yields (query index, query name, GO rows, hit target ids, distances, e-values)
+    #for the queries start:stop, hits are sorted by e-value, only the best k if k > 0
+    qnames,qdb = _shared['q']
+    tnames,tdb = _shared['t']
+    go = _shared['go']
+    ldb = len(tnames)
+    #queries are compared with the targets in tiles, keep a tile of distances around 32MB
+    shard = max(len(t) for t in tdb) if type(tdb) == list else ldb
+    qtile = max(1,min(64,(1<<23)//max(shard,1)))
+    for tileStart in range(start,stop,qtile):
+        tile = qdb[tileStart:min(tileStart+qtile,stop)]
+        for i,(ids,dbdiff,m,s) in enumerate(_tileDistances(tile,tdb,_shared['index']),tileStart):
+            qname = parseName(qnames[i])[0]
+            with _timed('evalue'): res,evals = _hits(dbdiff,m,s,ldb,thr,k)
+            _count('queries')
+            _count('candidates',len(dbdiff))
+            _count('hits',len(res))
+            #with k <= keep the kept candidates always hold the k best hits
+            if _shared['keep'] > 0 and not 0 < k <= _shared['keep'] and len(ids) == _shared['keep'] < ldb and len(res) > 0 and dbdiff[res[-1]] >= dbdiff.max():
+                print(f'Warning: more than {len(ids)} candidates for {qname}, increase --max-candidates to report all hits',file=sys.stderr)
+
+            goRows = []
+            if go is not None:
+                with _timed('annotation'):
+                    res2,e2 = _hits(dbdiff,m,s,ldb,gothr)
+                    for a in annotate(res2 if ids is None else ids[res2],e2,go):
+                        goRows.append([a[0], a[1], f'{a[2]:.3f}', parseName(tnames[a[3]])[0], a[5], f'{a[4]:.2e}'])
+                _count('goTerms',len(goRows))
+            yield i,qname,goRows,res if ids is None else ids[res],dbdiff[res]/2,evals
+
+def _homologRows(targets, dists, evals):
+    rows = []
+    for name,diff,ev in zip(_shared['t'][0][targets],dists,evals):
+        name = parseName(name)
+        rows.append([name[0], name[1], name[2], name[3], diff, f'{ev:.2e}'])
+    return rows
+
+def _search_chunk(task):
+    #results of the queries start:stop as tsv text or as packed hit records,
+    #one string per chunk is much cheaper to send back than lists of rows.
+    #Returns (results, worker pid, counters and timers of the chunk).
+    #queries is None for the query database of _search_init, the path of a
+    #query database or (names, quantizations) sent with the task.
+    thr,gothr,start,stop,taskInd,binary,k,queries = task
+    if type(queries) == str:
+        if _shared.get('qpath') != queries: _shared['q'],_shared['qpath'] = loadDB(queries),queries
+    elif queries is not None: _shared['q'],_shared['qpath'] = queries,None
+    from pyprost.hits import packHits
+    t0 = time.perf_counter()
+    out = []
+    for i,qname,goRows,targets,dists,evals in _searchQueries(thr,gothr,start,stop,taskInd,k):
+        with _timed('output'):
+            if binary: out.append(packHits(i,targets,dists,evals).tobytes())
+            else: out.extend(tsvRows({qname:goRows},{qname:_homologRows(targets,dists,evals)}))
+    with _timed('output'): out = b''.join(out) if binary else ''.join(out)
+    _count('busy',time.perf_counter()-t0)
+    _count('chunks')
+    _profileDump()
+    return out,os.getpid(),_takeStats()
+
+def _guidedChunks(n, jobs, maxChunk=64):
+    #guided scheduling, every chunk is a share of the remaining queries so chunks
+    #shrink towards the end and the workers that pull them finish together
+    start = 0
+    while start < n:
+        size = max(1,min(maxChunk,-(-(n-start)//(2*jobs))))
+        yield start,min(start+size,n)
+        start += size
+
+def _printUtilization(workers, wall):
+    busy = 0
+    for i,s in enumerate(sorted(workers.values(),key=lambda s: -s['busy'])):
+        print(f'Worker {i}: {s["queries"]} queries in {s["chunks"]} chunks, busy {s["busy"]:.1f}s ({100*s["busy"]/wall:.0f}%)')
+        busy += s['busy']
+    if len(workers) > 0: print(f'Search took {wall:.1f}s, workers were busy {100*busy/wall/len(workers):.0f}% of the time')
+
+def _printProgress(what, done, total, elapsed, extra=''):
+    rate = done/max(elapsed,1e-9)
+    eta = f', ETA {(total-done)/rate:.0f}s' if total is not None and rate > 0 else ''
+    print(f'{what} {done}{"" if total is None else "/"+str(total)} in {elapsed:.0f}s, {rate:.1f}/s{extra}{eta}',flush=True)
+
+def _tileDistances(queries, tdb, index):
+    #yields (target ids, distances, median, scaled MAD) for every query.
+    #ids is None when every target is scored, otherwise distances are only
+    #computed for the candidates of the index and the distance distribution
+    #is estimated from the null sample of the index.
+    if type(tdb) == list:
+        yield from _shardDistances(queries,tdb,_shared['keep'])
+        return
+    if index is None:
+        with _timed('distance'): dists = l1Distances(queries,tdb)
+        for dbdiff in dists:
+            with _timed('statistics'): m,mad = medianMAD(dbdiff)
+            yield None,dbdiff,m,mad*1.4826
+        return
+    from pyprost.index import probe
+    index,nprobe,nulldb = index
+    with _timed('distance'): null,cands = l1Distances(queries,nulldb),probe(index,queries,nprobe)
+    for q,ids,nd in zip(queries,cands,null):
+        with _timed('statistics'): m,mad = medianMAD(nd)
+        with _timed('distance'): dbdiff = l1Distances(q,tdb[ids])[0]
+        yield ids,dbdiff,m,mad*1.4826
+
+def _shardDistances(queries, shards, keep):
+    #distances are computed one shard at a time. The histograms of the
+    #distances give the exact median and MAD over all shards, and only the
+    #keep closest targets of every query are kept as candidates.
+    hists = [np.zeros(1,dtype=np.int64) for _ in queries]
+    dists = [np.empty(0,dtype=np.int32) for _ in queries]
+    ids = [np.empty(0,dtype=np.int64) for _ in queries]
+    offset = 0
+    t = time.perf_counter()
+    for shard in shards:
+        for j,d in enumerate(l1Distances(queries,shard)):
+            h = np.bincount(d)
+            if len(h) < len(hists[j]): h,hists[j] = hists[j],h
+            h[:len(hists[j])] += hists[j]
+            hists[j] = h
+            #once keep candidates are held only closer targets can replace them,
+            #of equally close targets the ones with smaller ids are kept
+            i = np.arange(len(d)) if len(dists[j]) < keep else np.nonzero(d < dists[j].max())[0]
+            if len(i) > keep: i = i[_closest(d[i],i,keep)]
+            d,i = np.concatenate([dists[j],d[i]]),np.concatenate([ids[j],offset+i])
+            if len(d) > keep:
+                top = _closest(d,i,keep)
+                d,i = d[top],i[top]
+            dists[j],ids[j] = d,i
+        offset += len(shard)
+    _count('distance',time.perf_counter()-t)
+    for j in range(len(queries)):
+        with _timed('statistics'): m,mad = histMedianMAD(hists[j],offset)
+        order = np.argsort(ids[j])
+        yield ids[j][order],dists[j][order],m,mad*1.4826
+
+def _sharedDB(path, tmpdir, name=None):
+    #v1 databases are converted once into a temporary v2 file that workers can memory map
+    if isPrdb2(path): return path
+    tmp = os.path.join(tmpdir,name or os.path.basename(path))
+    convertDB(path,tmp)
+    return tmp
+
+def _prepareTargets(targetdb, godb, index, tmpdir):
+    #returns the target database and GO tables in the form _search_init expects.
+    #A directory or a glob pattern of databases is searched shard by shard.
+    shards = None
+    if not os.path.isfile(targetdb):
+        shards = shardPaths(targetdb)
+        if len(shards) == 0: raise click.ClickException(f'No databases found in {targetdb}')
+        if index is not None: raise click.ClickException('An index can only be used with a single target database')
+    go = None
     if godb != None:
-        with open(godb,'rb') as f:
-            go,goFrq,goDesc = load(f)
-    with open(querydb,'rb') as f:
-        qnames,qdb = loads(blosc.decompress(f.read()))
-    with open(targetdb,'rb') as f:
-        tnames,tdb = loads(blosc.decompress(f.read()))
-    ldb = len(tdb)
-    homologList, goList = {},{}
-
-    mem = np.zeros((n,ldb,475),dtype='int8')
-    with Pool(n) as pool:
-        if godb != None: items = [(thr, gothr, qnames,qdb,tnames,tdb, go,goFrq,goDesc, mem[i], i, n) for i in range(n)]
-        else: items = [(thr, gothr, qnames,qdb,tnames,tdb, None,None,None, mem[i], i, n) for i in range(n)]
-        for result in pool.starmap(_search_worker, items):
-            homologList.update(result[1])
-            goList.update(result[0])
-    return goList,homologList
-
-def toTSV(goList,homologList,out):
-    with open(out+'.tsv','w') as f:
-        for queryP in homologList:
-            for go in goList[queryP]:
-                f.write(f'{queryP}\t'+'\t'.join([str(i) for i in go])+'\n')
-            for hom in homologList[queryP]:
-                f.write(f'{queryP}\t'+'\t'.join([str(i) for i in hom])+'\n')
+        go = loadGO(godb)
+        for k in ('indptr','indices','freq'):
+            np.save(os.path.join(tmpdir,k+'.npy'),go[k])
+            go[k] = os.path.join(tmpdir,k+'.npy')
+    if shards is None:
+        targetdb = _sharedDB(targetdb,tmpdir)
+        if index is not None:
+            with np.load(index) as f: count = int(f['count'])
+            if count != len(ProstDB(targetdb)):
+                raise click.ClickException(f'The index was built for a database with {count} entries')
+        return targetdb,go,False
+    return [_sharedDB(path,tmpdir,f'shard{i}.prdb') for i,path in enumerate(shards)],go,True
+
+def _search(thr, gothr, querydb, targetdb, godb, n, out, binary=False, index=None, nprobe=32, keep=10000,
+            progress=10, summary=None, profile=None, k=0):
+    #searches in chunks of queries and writes the results of every chunk as soon as it
+    #is ready, in query order. out is a tsv file or a hits file if binary is set.
+    #Workers pull the next chunk when they are done with the previous one.
+    #A progress line is printed every progress seconds and the counters and timers
+    #of all workers are written as a JSON summary at the end, see _writeSummary.
+    #With k only the best k hits of every query are kept, shards keep k candidates.
+    if k > 0: keep = min(keep,k)
+    began = time.time()
+    _profileStart(profile,'search-main')
+    with TemporaryDirectory(prefix='prost') as tmpdir:
+        with _timed('prepare'):
+            targetdb,go,sharded = _prepareTargets(targetdb,godb,index,tmpdir)
+            querydb = _sharedDB(querydb,tmpdir)
+            lqdb = len(ProstDB(querydb))
+        items = [(thr,gothr,start,stop,ind,binary,k,None) for ind,(start,stop) in enumerate(_guidedChunks(lqdb,n))]
+        workers,total = {},{}
+        with Pool(n,initializer=_search_init,initargs=(querydb,targetdb,go,index,nprobe,keep if sharded else 0,profile)) as pool, \
+             open(out,'wb' if binary else 'w') as f:
+            t0 = lastProgress = time.time()
+            for block,pid,stats in pool.imap(_search_chunk,items):
+                with _timed('write'): f.write(block)
+                _addStats(workers.setdefault(pid,{}),stats)
+                _addStats(total,stats)
+                if progress > 0 and time.time()-lastProgress >= progress:
+                    _printProgress('Searched',total['queries'],lqdb,time.time()-t0,f', {total.get("hits",0)} hits')
+                    lastProgress = time.time()
+            wall = time.time()-t0
+            _printUtilization(workers,wall)
+    _addStats(total,_takeStats())
+    _profileDump(stop=True)
+    _writeSummary({'command':'search','queries':lqdb,'jobs':n,'wall':wall,'elapsed':time.time()-began,
+                   'queries_per_second':lqdb/max(wall,1e-9),'totals':total,
+                   'workers':[dict(s,pid=pid,utilization=s['busy']/max(wall,1e-9)) for pid,s in workers.items()]},summary)
+    return lqdb
+
+def tsvRows(goList,homologList):
+    for queryP in homologList:
+        for go in goList[queryP]:
+            yield f'{queryP}\t'+'\t'.join([str(i) for i in go])+'\n'
+        for hom in homologList[queryP]:
+            yield f'{queryP}\t'+'\t'.join([str(i) for i in hom])+'\n'
 
 def createAlignmentPage(p1,p2):
     return {
@@ -534,19 +1253,215 @@ PROST [python package](https://github.com/MesihK/prost) can be used to generate
 @click.command()
 @click.option('--thr', default=0.05, help='E-value threshold for homolog detection')
 @click.option('-n', '--jobs', default=1, help='Number of jobs to run in parallel')
+@click.option('-i', '--index', default=None, type=click.Path(exists=True,file_okay=True,dir_okay=False), help='Prefilter index of the target database created with mkindex')
+@click.option('--nprobe', default=32, help='Number of index clusters to score for each query')
+@click.option('--max-candidates', default=10000, type=click.IntRange(1), help='Closest targets kept per query when searching shards')
+@click.option('--format', 'fmt', default='tsv', type=click.Choice(['tsv','hits']), help='Write tsv rows or binary hit records (query index, target index, distance, e-value)')
+@click.option('-k', '--top-k', default=0, type=int, help='Report only the k best hits below --thr of every query (0 for all)')
+@click.option('--progress', default=10, type=int, help='Seconds between progress lines (0 for none)')
+@click.option('--stats', default=None, type=click.Path(exists=False,file_okay=True,dir_okay=False), help='Write the JSON summary of counters and timers to this file instead of stdout')
+@click.option('--profile', default=None, type=click.Path(exists=False,file_okay=False,dir_okay=True), help='Write a cProfile file of every process into this directory')
 @click.argument('querydb', type=click.Path(exists=True,file_okay=True,dir_okay=False))
-@click.argument('targetdb', type=click.Path(exists=True,file_okay=True,dir_okay=False))
+@click.argument('targetdb', type=click.Path(exists=False,file_okay=True,dir_okay=True))
 @click.argument('out', type=click.Path(exists=False,file_okay=True,dir_okay=False))
-def search(thr, jobs, querydb, targetdb, out):
+def search(thr, jobs, index, nprobe, max_candidates, fmt, top_k, progress, stats, profile, querydb, targetdb, out):
     '''Search a query database in target database.
 This command searches a query database against a target database.
 Both databases should be created using makedb command.
 Databases can contain one or more sequences.
-An e-value threshold can be specified with --thr flag. The default e-value threshold is 0.05'''
-    goList,homologList = _search(thr,None,querydb,targetdb,None,jobs)
-    print(f'Saving results into {out}.tsv.')
-    toTSV(goList,homologList,out)
-    print(f'You can use `prost tojsonwp` command to convert {out}.tsv results into a webpage!')
+An e-value threshold can be specified with --thr flag. The default e-value threshold is 0.05
+With --index only the targets in the --nprobe closest clusters of the index are scored.
+TARGETDB can also be a directory or a quoted glob pattern of databases, such as the
+split files of makedb. Shards are searched one at a time without merging them.
+Results are written while the search runs. --format hits writes compact binary
+records to OUT.hits instead, they can be read with pyprost.loadHits.
+With --top-k K only the K hits with the lowest e-values are written for every query, the
+e-values of the other targets are not computed and shards keep only K candidates.
+Progress is printed every --progress seconds. At the end a JSON summary of the counters
+and the load, distance, statistics, e-value, annotation and output times of all workers
+is printed or written to --stats. --profile DIR writes DIR/search-*-PID.prof cProfile files
+that can be read with pstats or snakeviz.'''
+    print(f'Saving results into {out}.{fmt}.')
+    _search(thr,None,querydb,targetdb,None,jobs,f'{out}.{fmt}',fmt == 'hits',index,nprobe,max_candidates,progress,stats,profile,top_k)
+    if fmt == 'tsv': print(f'You can use `prost tojsonwp` command to convert {out}.tsv results into a webpage!')
+
+@click.command()
+@click.option('--thr', default=0.05, help='E-value threshold for homolog detection')
+@click.option('--gothr', default=0.05, help='E-value threshold for GO annotation')
+@click.option('--godb', default=None, type=click.Path(exists=True,file_okay=True,dir_okay=False), help='GO annotations of the target database created with mkgo')
+@click.option('-n', '--jobs', default=1, help='Number of search processes')
+@click.option('-i', '--index', default=None, type=click.Path(exists=True,file_okay=True,dir_okay=False), help='Prefilter index of the target database created with mkindex')
+@click.option('--nprobe', default=32, help='Number of index clusters to score for each query')
+@click.option('--max-candidates', default=10000, type=click.IntRange(1), help='Closest targets kept per query when searching shards')
+@click.option('--no-cache', is_flag=True, default=False, help='Do not use the quantization cache')
+@click.option('--batch-tokens', default=0, type=int, help='Embed equal length sequences together in batches of this many tokens (0 to embed one by one)')
+@click.argument('fasta', type=click.Path(exists=True,file_okay=True,dir_okay=False))
+@click.argument('targetdb', type=click.Path(exists=False,file_okay=True,dir_okay=True))
+@click.argument('out', type=click.Path(exists=False,file_okay=True,dir_okay=False))
+def query(thr, gothr, godb, jobs, index, nprobe, max_candidates, no_cache, batch_tokens, fasta, targetdb, out):
+    '''Embed the sequences of a FASTA file and search them in a target database.
+This command is makedb followed by search without the intermediate query database.
+Every sequence is sent to the search processes as soon as it is quantized, so
+the next sequence is embedded while the previous ones are searched.
+Results are written to the tsv output in the order of the FASTA file.'''
+    cache = {} if no_cache else _openCache()
+    with TemporaryDirectory(prefix='prost') as tmpdir:
+        targetdb,go,sharded = _prepareTargets(targetdb,godb,index,tmpdir)
+        if go is None: gothr = None
+        #the pool is forked before the model is loaded in this process
+        with Pool(jobs,initializer=_search_init,initargs=(None,targetdb,go,index,nprobe,max_candidates if sharded else 0)) as pool, \
+             open(out+'.tsv','w') as f:
+            tasks = deque()
+            def write(block):
+                while len(tasks) > 0 and (block or tasks[0].ready()):
+                    f.write(tasks.popleft().get()[0])
+                    block = False
+            try:
+                for name,seq,q,cached in _quantRecords(_validRecords(fasta),cache,batch_tokens):
+                    queries = ([name],np.array([q],dtype='int8'))
+                    tasks.append(pool.apply_async(_search_chunk,((thr,gothr,0,1,0,False,0,queries),)))
+                    write(len(tasks) > 4*jobs)
+                while len(tasks) > 0: write(True)
+            finally:
+                if not no_cache: cache.close()
+    print(f'Results are saved into {out}.tsv.')
+
+def _parseQueries(body, embedLock):
+    #returns the query names and quantizations of a request body, which is
+    #a v2 database, a JSON object of name -> quantization or FASTA text
+    from pyprost.prdb import MAGIC
+    if body.startswith(MAGIC):
+        from tempfile import NamedTemporaryFile
+        with NamedTemporaryFile(suffix='.prdb') as f:
+            f.write(body)
+            f.flush()
+            names,db = loadDB(f.name)
+            return list(names),np.array(db)
+    try: text = body.decode()
+    except UnicodeDecodeError: raise ValueError('queries must be FASTA, JSON or a v2 database')
+    if text.lstrip().startswith('{'):
+        queries = json.loads(text)
+        return list(queries),np.array(list(queries.values()),dtype='int8').reshape(len(queries),475)
+    from io import StringIO
+    from pyprost import quantSeqBatch
+    names,seqs = [],[]
+    for name,seq in fasta_iter(StringIO(text)):
+        valid,aa = check_seq(seq)
+        if not valid: raise ValueError(f'{name} contains unknown amino acid {aa}')
+        names.append(name)
+        seqs.append(seq.upper())
+    if len(seqs) == 0: raise ValueError('no queries in the request')
+    with embedLock:
+        return names,np.array(quantSeqBatch(seqs),dtype='int8')
+
+def _serveBatches(jobs, pool, n, tmpdir, wait, maxBatch):
+    #collects the requests that arrive within wait seconds of each other and
+    #searches them with one round of the worker pool. The queries of every
+    #request are split into guided chunks, so results come back per request.
+    from queue import Empty
+    batchInd = 0
+    while True:
+        batch = [jobs.get()]
+        deadline = time.time()+wait
+        while sum(len(j['names']) for j in batch) < maxBatch:
+            try: batch.append(jobs.get(timeout=max(0,deadline-time.time())))
+            except Empty: break
+        key = lambda j: (j['thr'],j['gothr'])
+        for (thr,gothr),group in groupby(sorted(batch,key=key),key=key):
+            group = list(group)
+            try:
+                querydb = os.path.join(tmpdir,f'batch{batchInd}.prdb')
+                batchInd += 1
+                saveDB(querydb,[name for j in group for name in j['names']],np.concatenate([j['quant'] for j in group]))
+                items,owner,offset = [],[],0
+                for j in group:
+                    for start,stop in _guidedChunks(len(j['names']),n):
+                        items.append((thr,gothr,offset+start,offset+stop,len(items),False,0,querydb))
+                        owner.append(j)
+                    offset += len(j['names'])
+                    j['result'] = ''
+                for j,(block,pid,stats) in zip(owner,pool.imap(_search_chunk,items)):
+                    j['result'] += block
+                os.remove(querydb)
+            except Exception as e:
+                for j in group: j['error'] = str(e)
+            for j in group: j['done'].set()
+
+def _serveHandler(jobs, embedLock, thr, gothr, count):
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlparse,parse_qs
+    import threading
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, code, text):
+            data = text.encode()
+            self.send_response(code)
+            self.send_header('Content-Type','text/tab-separated-values' if code == 200 else 'text/plain')
+            self.send_header('Content-Length',str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.reply(200,f'PROST server, {count} targets\n')
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/search': return self.reply(404,'POST queries to /search\n')
+            params = parse_qs(url.query)
+            body = self.rfile.read(int(self.headers.get('Content-Length',0)))
+            try:
+                names,quant = _parseQueries(body,embedLock)
+                job = {'names':names,'quant':quant,'done':threading.Event(),
+                       'thr':float(params['thr'][0]) if 'thr' in params else thr,
+                       'gothr':float(params['gothr'][0]) if 'gothr' in params and gothr is not None else gothr}
+            except Exception as e: return self.reply(400,f'{e}\n')
+            jobs.put(job)
+            job['done'].wait()
+            if 'error' in job: return self.reply(500,job['error']+'\n')
+            self.reply(200,job['result'])
+    return Handler
+
+@click.command()
+@click.option('--host', default='127.0.0.1', help='Address to listen on')
+@click.option('--port', default=8765, help='Port to listen on')
+@click.option('--thr', default=0.05, help='Default e-value threshold for homolog detection')
+@click.option('--gothr', default=0.05, help='Default e-value threshold for GO annotation')
+@click.option('--godb', default=None, type=click.Path(exists=True,file_okay=True,dir_okay=False), help='GO annotations of the target database created with mkgo')
+@click.option('-n', '--jobs', default=1, help='Number of search processes')
+@click.option('-i', '--index', default=None, type=click.Path(exists=True,file_okay=True,dir_okay=False), help='Prefilter index of the target database created with mkindex')
+@click.option('--nprobe', default=32, help='Number of index clusters to score for each query')
+@click.option('--max-candidates', default=10000, type=click.IntRange(1), help='Closest targets kept per query when searching shards')
+@click.option('--batch-wait', default=0.05, help='Seconds to wait for more requests before searching a batch')
+@click.option('--max-batch', default=256, help='Maximum number of queries searched together')
+@click.option('--preload-model', is_flag=True, default=False, help='Load the ESM model at start up instead of on the first FASTA request')
+@click.argument('targetdb', type=click.Path(exists=False,file_okay=True,dir_okay=True))
+def serve(host, port, thr, gothr, godb, jobs, index, nprobe, max_candidates, batch_wait, max_batch, preload_model, targetdb):
+    '''Serve searches against a target database over HTTP.
+The target database, GO tables and search processes are loaded once and
+stay resident. POST a FASTA file, a JSON object of name -> quantization or a
+database created with makedb to /search, optionally with ?thr=...&gothr=...,
+and the same rows as the tsv output of search are returned:
+
+curl --data-binary @queries.fasta http://127.0.0.1:8765/search
+
+Requests that arrive within --batch-wait seconds are searched together.'''
+    from http.server import ThreadingHTTPServer
+    from queue import Queue
+    import threading
+    if preload_model:
+        from pyprost.esmts25_13 import _load
+        _load()
+    with TemporaryDirectory(prefix='prost') as tmpdir:
+        targetdb,go,sharded = _prepareTargets(targetdb,godb,index,tmpdir)
+        count = sum(len(ProstDB(p)) for p in targetdb) if sharded else len(ProstDB(targetdb))
+        if go is None: gothr = None
+        pending = Queue()
+        with Pool(jobs,initializer=_search_init,initargs=(None,targetdb,go,index,nprobe,max_candidates if sharded else 0)) as pool:
+            threading.Thread(target=_serveBatches,args=(pending,pool,jobs,tmpdir,batch_wait,max_batch),daemon=True).start()
+            handler = _serveHandler(pending,threading.Lock(),thr,gothr,count)
+            with ThreadingHTTPServer((host,port),handler) as server:
+                print(f'Serving {count} targets on http://{host}:{port}/search')
+                try: server.serve_forever()
+                except KeyboardInterrupt: pass
 
 @click.command()
 @click.option('--thr', default=0.05, help='E-value threshold for homolog detection')
@@ -561,9 +1476,21 @@ Query database should be created using makedb command.
 It can contain one or more sequences.
 An e-value threshold can be specified with --thr flag. The default e-value threshold is 0.05.
 An seperate GO annotation threshold can be specified with --gothr flag. The default is 0.05.'''
-    goList,homologList = _search(thr,gothr,querydb,prostdir+'/sp.02.23.parsed.prdb',prostdir+'/sp.02.23.go.pkl',jobs)
+    from pyprost import _init_prost_files
+    _init_prost_files()
+    spdb = prostdir+'/sp.02.23.parsed.v2.prdb'
+    if not os.path.exists(spdb):
+        print('Convert SwissProt database into v2 format, this is done only once.')
+        convertDB(prostdir+'/sp.02.23.parsed.prdb',spdb+'.tmp')
+        os.replace(spdb+'.tmp',spdb)
+    spgo = prostdir+'/sp.02.23.go.csr.pkl'
+    if not os.path.exists(spgo):
+        print('Convert SwissProt GO annotations into tables, this is done only once.')
+        with open(spgo+'.tmp','wb') as f:
+            dump(loadGO(prostdir+'/sp.02.23.go.pkl'),f)
+        os.replace(spgo+'.tmp',spgo)
     print(f'Saving results into {out}.tsv.')
-    toTSV(goList,homologList,out)
+    _search(thr,gothr,querydb,spdb,spgo,jobs,out+'.tsv')
     print(f'You can use `prost tojsonwp` command to convert {out}.tsv results into a webpage!')
         
 @click.command()
@@ -593,6 +1520,154 @@ def tojsonwp(tsv, align, info, out):
         cur += toJSONWP(None,None,None,None,info,align,goList,homologList,prots[cur:],out+f'.{i}')
         i += 1
     
+def _benchData(path, targets, queries, residues, terms, seed):
+    #synthetic databases: targets are noisy members of families of 50 so that
+    #queries, which are noisy family members too, have hits. Every family has
+    #its own GO terms, targets get a random extra term now and then.
+    rng = np.random.default_rng(seed)
+    families = max(1,targets//50)
+    centers = rng.integers(-100,101,(families,475))
+    fam = rng.integers(0,families,targets)
+    tdb = np.clip(centers[fam]+rng.integers(-30,31,(targets,475)),-127,127).astype(np.int8)
+    qfam = rng.integers(0,families,queries)
+    qdb = np.clip(centers[qfam]+rng.integers(-30,31,(queries,475)),-127,127).astype(np.int8)
+    name = lambda p,i: f'sp|{p}{i:07d}|{p}{i}_BENCH Synthetic protein {i} OS=Synthetic OX=0 GN=S{i} PE=1 SV=1'
+    saveDB(path+'/targets.prdb',[name('T',i) for i in range(targets)],tdb)
+    saveDB(path+'/queries.prdb',[name('Q',i) for i in range(queries)],qdb)
+
+    famTerms = rng.integers(0,terms,(families,3))
+    godbl = [['GO:%07d' % t for t in set(famTerms[f][:1+i%3])|({int(rng.integers(terms))} if i%4 == 0 else set())]
+             for i,f in enumerate(fam)]
+    frq = {}
+    for l in godbl:
+        for t in l: frq[t] = frq.get(t,0)+1
+    frq['count'] = sum(len(l) for l in godbl)
+    with open(path+'/go.pkl','wb') as f:
+        dump(goTables(godbl,frq,{t:f'synthetic term {t}' for t in frq}),f)
+
+    amino = np.array(list('ACDEFGHIKLMNPQRSTVWY'))
+    with open(path+'/seqs.fasta','w') as f:
+        i = 0
+        while residues > 0:
+            l = int(min(max(rng.lognormal(5.8,0.5),30),2000))
+            f.write(f'>seq{i}\n{"".join(rng.choice(amino,l))}\n')
+            residues -= l
+            i += 1
+
+def _peakRSS():
+    #peak resident set size in MB of this process and of its finished children
+    import resource
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {'peak_rss_mb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale/2**20,
+            'children_peak_rss_mb':resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*scale/2**20}
+
+@click.command()
+@click.option('--targets', default=100000, help='Entries of the synthetic target database')
+@click.option('--queries', default=200, help='Entries of the synthetic query database')
+@click.option('--residues', default=50000, help='Residues of the synthetic FASTA file that is embedded')
+@click.option('--terms', default=5000, help='Number of distinct GO terms')
+@click.option('--thr', default=0.05, help='E-value threshold of a hit')
+@click.option('-n', '--jobs', default=1, help='Number of search processes of the end to end search')
+@click.option('-b', '--batch-tokens', default=4096, type=int, help='Batch size of the embedding in tokens')
+@click.option('--no-embed', is_flag=True, default=False, help='Skip the stages that need the model')
+@click.option('--seed', default=0)
+@click.option('-o', '--out', default=None, type=click.Path(exists=False,file_okay=True,dir_okay=False), help='Append the JSON lines to this file instead of printing them')
+def bench(targets, queries, residues, terms, thr, jobs, batch_tokens, no_embed, seed, out):
+    '''Times every stage of makedb and search on synthetic data.
+Random target and query databases, GO annotations and a FASTA file are created in a
+temporary directory. One JSON line is printed for every stage with its time, throughput
+and the peak RSS of the process so far: database load, L1 distances, median/MAD,
+e-values, GO enrichment, TSV writing, an end to end search with --jobs processes,
+embedding and quant2D. Runs of different versions on the same machine can be compared.'''
+    import platform
+    from scipy.special import ndtr
+    lines = []
+    def report(stage, seconds, **extra):
+        lines.append(json.dumps({'stage':stage,'seconds':seconds,**extra,**_peakRSS()}))
+        click.echo(lines[-1])
+    report('setup',0.0,targets=targets,queries=queries,cpus=cpu_count(),python=platform.python_version(),
+           numpy=np.__version__,machine=platform.machine())
+
+    with TemporaryDirectory(prefix='prost') as tmpdir:
+        t = time.time()
+        _benchData(tmpdir,targets,queries,residues,terms,seed)
+        report('generate',time.time()-t)
+
+        t = time.time()
+        _search_init(tmpdir+'/queries.prdb',tmpdir+'/targets.prdb',None)
+        qdb,tdb = np.asarray(_shared['q'][1]),_shared['t'][1]
+        tdb.sum(axis=1)   #read every page
+        elapsed = time.time()-t
+        report('db_load',elapsed,entries_per_second=targets/elapsed,mb_per_second=tdb.nbytes/2**20/elapsed)
+
+        t = time.time()
+        dists = l1Distances(qdb,tdb)
+        elapsed = time.time()-t
+        report('distance',elapsed,comparisons_per_second=queries*targets/elapsed)
+
+        t = time.time()
+        stats = [medianMAD(d) for d in dists]
+        elapsed = time.time()-t
+        report('median_mad',elapsed,queries_per_second=queries/elapsed)
+
+        t = time.time()
+        hits = [_hits(d,m,mad*1.4826,targets,thr) for d,(m,mad) in zip(dists,stats)]
+        elapsed = time.time()-t
+        nhits = sum(len(res) for res,e in hits)
+        report('evalue',elapsed,queries_per_second=queries/elapsed,hits=nhits)
+        #the e-values of all targets, for comparison with the cutoff in _hits
+        t = time.time()
+        for d,(m,mad) in zip(dists,stats): ndtr((d-m)/(mad*1.4826))*targets
+        report('evalue_all_targets',time.time()-t)
+
+        go = loadGO(tmpdir+'/go.pkl')
+        t = time.time()
+        goRows = [annotate(res,e,go) for res,e in hits]
+        elapsed = time.time()-t
+        report('go_enrichment',elapsed,queries_per_second=queries/elapsed,terms=sum(len(r) for r in goRows))
+
+        t = time.time()
+        qnames = _shared['q'][0]
+        with open(tmpdir+'/out.tsv','w') as f:
+            for i,((res,e),rows) in enumerate(zip(hits,goRows)):
+                qname = parseName(qnames[i])[0]
+                f.writelines(tsvRows({qname:rows},{qname:_homologRows(res,dists[i][res],e)}))
+        elapsed = time.time()-t
+        report('tsv',elapsed,rows_per_second=nhits/elapsed,bytes=os.path.getsize(tmpdir+'/out.tsv'))
+        del dists
+
+        t = time.time()
+        with open(os.devnull,'w') as null:
+            stdout,sys.stdout = sys.stdout,null
+            try: _search(thr,thr,tmpdir+'/queries.prdb',tmpdir+'/targets.prdb',tmpdir+'/go.pkl',jobs,tmpdir+'/search.tsv')
+            finally: sys.stdout = stdout
+        elapsed = time.time()-t
+        report('search',elapsed,jobs=jobs,queries_per_second=queries/elapsed)
+
+        if not no_embed:
+            from pyprost.esmts25_13 import embedBatch
+            from pyprost.prosttools import quantEmbBatch
+            seqs = [seq for _,seq in fasta_iter(tmpdir+'/seqs.fasta')]
+            nres = sum(len(seq) for seq in seqs)
+            try:
+                t = time.time()
+                embedBatch(seqs[:1])
+                report('model_load',time.time()-t)
+                t = time.time()
+                embs = embedBatch(seqs,batch_tokens)
+                elapsed = time.time()-t
+                report('embed',elapsed,sequences=len(seqs),residues_per_second=nres/elapsed,seconds_per_residue=elapsed/nres)
+                t = time.time()
+                quantEmbBatch(embs)
+                elapsed = time.time()-t
+                report('quant2d',elapsed,sequences=len(seqs),residues_per_second=nres/elapsed,seconds_per_residue=elapsed/nres)
+            except Exception as e:
+                report('embed',0.0,skipped=str(e))
+
+    if out is not None:
+        with open(out,'a') as f:
+            f.writelines(l+'\n' for l in lines)
+
 @click.group()
 def cli():
     '''PROST python package v0.2.15
@@ -604,10 +1679,16 @@ searchsp: searches a query database against SwissProt February 2023 database. Qu
 
 cli.add_command(makedb)
 cli.add_command(mergedbs)
+cli.add_command(convertdb)
+cli.add_command(mkindex)
 cli.add_command(search)
+cli.add_command(query)
+cli.add_command(serve)
 cli.add_command(searchsp)
 cli.add_command(mkgo)
 cli.add_command(mkcache)
+cli.add_command(checkruntime)
+cli.add_command(bench)
 cli.add_command(parseUniprotNames)
 cli.add_command(tojsonwp)
 
@@ -54,5 +54,14 @@ def _init_prost_files():
     download_file('sp.02.23.go.pkl','Downloading SwissProt February 2023 GO Annotations','e142f46823b2987ee219516b152ac430')
     download_file('cache.pkl','Downloading PROST cache','7bc8a2f843af0cfb4d5af8ef574b7a34')
 
-_init_prost_files()
-from .prosttools import quantSeq,prostDistance
+#the package level names are imported on first use, so importing a submodule
+#like pyprost.prdb in bin/prost.py loads nothing else
+_exports = {'quantSeq':'prosttools','quantSeqBatch':'prosttools','quantEmbBatch':'prosttools',
+            'prostDistance':'prosttools','prostDistanceMatrix':'prosttools',
+            'loadDB':'prdb','saveDB':'prdb','convertDB':'prdb','ProstDB':'prdb',
+            'EmbeddingCache':'cache','loadHits':'hits'}
+
+def __getattr__(name):
+    if name not in _exports: raise AttributeError(f"module 'pyprost' has no attribute '{name}'")
+    from importlib import import_module
+    return getattr(import_module('.'+_exports[name],__name__),name)
@@ -0,0 +1,97 @@
+'''On disk quantization cache.
+
+Quantizations are stored in a SQLite database keyed by a 128 bit BLAKE2 hash
+of the sequence, so a lookup reads one row instead of loading the whole cache.
+Inserts are committed immediately and SQLite's locking makes the cache safe to
+share between several makedb processes.
+'''
+import hashlib
+import sqlite3
+import time
+import numpy as np
+
+def seqKey(seq):
+    return hashlib.blake2b(seq.encode(), digest_size=16).digest()
+
+class EmbeddingCache:
+    '''Dictionary like sequence -> quantization cache stored in a SQLite file.
+
+    If maxEntries is given the least recently used entries are evicted on
+    flush() and close() once the cache grows past it.'''
+    def __init__(self, path, maxEntries=0, timeout=600):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS quant (key BLOB PRIMARY KEY, quant BLOB NOT NULL, used REAL NOT NULL) WITHOUT ROWID')
+        self.db.execute('CREATE INDEX IF NOT EXISTS quant_used ON quant (used)')
+        self.used = {}
+
+    def get(self, seq, default=None):
+        key = seqKey(seq)
+        row = self.db.execute('SELECT quant FROM quant WHERE key=?', (key,)).fetchone()
+        if row is None: return default
+        if self.maxEntries > 0: self.used[key] = time.time()
+        return np.frombuffer(row[0], dtype='int8')
+
+    def __getitem__(self, seq):
+        q = self.get(seq)
+        if q is None: raise KeyError(seq)
+        return q
+
+    def __contains__(self, seq):
+        return self.db.execute('SELECT 1 FROM quant WHERE key=?', (seqKey(seq),)).fetchone() is not None
+
+    def __setitem__(self, seq, quant):
+        self.update({seq: quant})
+
+    def update(self, items):
+        '''Inserts sequence -> quantization pairs in one transaction.'''
+        now = time.time()
+        rows = [(seqKey(seq), np.asarray(q, dtype='int8').tobytes(), now) for seq, q in dict(items).items()]
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.executemany('INSERT OR REPLACE INTO quant VALUES (?,?,?)', rows)
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM quant').fetchone()[0]
+
+    def flush(self):
+        '''Records the access times of looked up entries and evicts old entries.'''
+        if self.maxEntries <= 0: return
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.executemany('UPDATE quant SET used=? WHERE key=?', [(t, k) for k, t in self.used.items()])
+            extra = len(self)-self.maxEntries
+            if extra > 0:
+                self.db.execute('DELETE FROM quant WHERE key IN (SELECT key FROM quant ORDER BY used LIMIT ?)', (extra,))
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.used = {}
+
+    def importPickle(self, path, chunk=100000):
+        '''Imports a pickled {sequence: quantization} dictionary such as cache.pkl.'''
+        from pickle import load
+        with open(path, 'rb') as f:
+            cache = load(f)
+        items = list(cache.items())
+        for i in range(0, len(items), chunk):
+            self.update(items[i:i+chunk])
+        return len(items)
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
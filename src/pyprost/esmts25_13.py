@@ -1,5 +1,3 @@
-import torch
-from esm.data import Alphabet
 import numpy as np
 import multiprocessing
 
@@ -8,53 +6,201 @@ from pathlib import Path
 if 'PROSTDIR' in os.environ: prostdir = os.environ['PROSTDIR']
 else: prostdir = str(Path.home())+'/.config/prost'
 
-torch.set_num_threads(multiprocessing.cpu_count())
+esm1b = None
+batch_converter = None
 
-#https://github.com/pytorch/pytorch/issues/52286
-#torch._C._jit_set_bailout_depth(0) # Use _jit_set_fusion_strategy, bailout depth is deprecated.
+#fp32: the traced model, frozen and optimized on the CPU
+#bf16: the traced model with bfloat16 weights
+#int8: the traced model with dynamically quantized int8 linear layers, CPU only
+#onnx: the traced model exported to ONNX and run with ONNX Runtime, CPU only
+RUNTIMES = ('fp32','bf16','int8','onnx')
+runtime = os.environ.get('PROST_RUNTIME','fp32')
 
-esm1b = torch.jit.load(prostdir+'/traced_esm1b_25_13.pt').eval()
-alphabet = Alphabet.from_architecture("ESM-1b")
-batch_converter = alphabet.get_batch_converter()
+def setRuntime(mode):
+    '''Selects how the model is run, one of RUNTIMES. The model is reloaded on the next embedding.'''
+    global runtime,esm1b
+    if mode not in RUNTIMES: raise ValueError(f'Unknown runtime {mode}, expected one of {", ".join(RUNTIMES)}')
+    if mode != runtime: esm1b = None
+    runtime = mode
 
-#https://stackoverflow.com/a/63616077
-#This prevents memory leak
-for param in esm1b.parameters():
-    param.grad = None
-    param.requires_grad = False
+def _cuda():
+    import torch
+    return torch.cuda.is_available() and runtime in ('fp32','bf16')
 
-if torch.cuda.is_available():
-    esm1b = esm1b.cuda()
-else:
-    torch._C._jit_set_profiling_mode(False)
-    torch.set_num_threads(multiprocessing.cpu_count())
-    esm1b = torch.jit.freeze(esm1b)
-    esm1b = torch.jit.optimize_for_inference(esm1b)
+def _traced():
+    import torch
+    model = torch.jit.load(prostdir+'/traced_esm1b_25_13.pt').eval()
+
+    #https://stackoverflow.com/a/63616077
+    #This prevents memory leak
+    for param in model.parameters():
+        param.grad = None
+        param.requires_grad = False
+    return model
+
+def _loadOnnx():
+    #the export is saved next to the traced model, tokens have dynamic batch and length axes
+    import torch
+    import onnxruntime
+    path = f'{prostdir}/traced_esm1b_25_13-{torch.__version__}.onnx'
+    if not os.path.exists(path):
+        _, _, toks = batch_converter([("prot","MKTAYIAKQRQISFVKSHFSRQ")]*2)
+        #makedb workers export at the same time, each writes its own file
+        tmp = f'{path}.{os.getpid()}.tmp'
+        torch.onnx.export(_traced(),(toks,),tmp,input_names=['tokens'],output_names=['layer13','layer25'],
+                          dynamic_axes={'tokens':{0:'batch',1:'length'}},opset_version=17)
+        os.replace(tmp,path)
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = torch.get_num_threads()
+    return onnxruntime.InferenceSession(path,options,providers=['CPUExecutionProvider'])
+
+def _load(threads=0):
+    #the model is loaded on the first embedding, so importing pyprost does not need torch.
+    #threads limits the torch threads and the threads of an ONNX Runtime session,
+    #by default all cores are used.
+    global esm1b,batch_converter
+    if esm1b is not None: return
+    import torch
+    from esm.data import Alphabet
+    from . import _init_prost_files
+    _init_prost_files()
+
+    torch.set_num_threads(threads if threads > 0 else multiprocessing.cpu_count())
+
+    #https://github.com/pytorch/pytorch/issues/52286
+    #torch._C._jit_set_bailout_depth(0) # Use _jit_set_fusion_strategy, bailout depth is deprecated.
+
+    alphabet = Alphabet.from_architecture("ESM-1b")
+    batch_converter = alphabet.get_batch_converter()
+
+    if runtime == 'onnx':
+        esm1b = _loadOnnx()
+        return
+
+    #freezing and optimizing the traced model takes a long time, the result is saved for later runs
+    mode = '' if runtime == 'fp32' else '.'+runtime
+    optimized = f'{prostdir}/traced_esm1b_25_13{mode}.optimized-{torch.__version__}.pt'
+    if not _cuda() and os.path.exists(optimized):
+        torch._C._jit_set_profiling_mode(False)
+        try:
+            esm1b = torch.jit.load(optimized).eval()
+            return
+        except Exception as e:
+            print('Could not load the optimized model, it is optimized again:',e)
+
+    model = _traced()
+    if runtime == 'bf16': model = model.to(torch.bfloat16)
+
+    if _cuda():
+        model = model.cuda()
+    else:
+        torch._C._jit_set_profiling_mode(False)
+        if runtime == 'int8':
+            #the traced model has no nn.Linear modules to swap, its graph is quantized instead
+            from torch.ao.quantization import quantize_dynamic_jit,default_dynamic_qconfig
+            model = quantize_dynamic_jit(model,{'':default_dynamic_qconfig})
+        else:
+            model = torch.jit.freeze(model)
+            #optimize_for_inference converts to mkldnn fp32 layouts
+            if runtime == 'fp32': model = torch.jit.optimize_for_inference(model)
+        #makedb workers optimize the model at the same time, each writes its own file
+        tmp = f'{optimized}.{os.getpid()}.tmp'
+        try:
+            torch.jit.save(model,tmp)
+            os.replace(tmp,optimized)
+        except Exception as e:
+            print('Could not save the optimized model:',e)
+            if os.path.exists(tmp): os.remove(tmp)
+    esm1b = model
+
+def _run(toks):
+    #model outputs of a batch of tokens as float32 numpy arrays
+    if runtime == 'onnx': return esm1b.run(None,{'tokens':toks.numpy()})
+    if _cuda(): toks = toks.to(device="cuda", non_blocking=True)
+    results = esm1b(toks)
+    if runtime == 'bf16': return [r.to(device="cpu").float().detach().numpy() for r in results]
+    return [r.to(device="cpu").detach().numpy() for r in results]
 
 def _embed(seq):
+    _load()
     _, _, toks = batch_converter([("prot",seq)])
-    if torch.cuda.is_available():
-        toks = toks.to(device="cuda", non_blocking=True)
-    results = esm1b(toks)
-    for i in range(len(results)):
-        results[i] = results[i].to(device="cpu")[0].detach().numpy()
-    return results
+    return [r[0] for r in _run(toks)]
 
-def embed(seq):
-    l = len(seq)
-    embtoks = None
-    if l > 1022:
-        piece = int(l/1022)+1
+def _embedBatch(seqs):
+    #sequences have to be of equal length. The model was traced without
+    #padding, padded batches would attend to the padding tokens.
+    _load()
+    _, _, toks = batch_converter([("prot",seq) for seq in seqs])
+    results = _run(toks)
+    return [[r[b] for r in results] for b in range(len(seqs))]
+
+def embedBatch(seqs, maxTokens=4096, overlap=0):
+    '''Embeds a list of sequences, returns the same as [embed(s) for s in seqs] up
+to floating point rounding, batched kernels do not sum in the same order, so
+quantizations of the results can differ by 1 in rare codes.
+Sequences with the same length are run through the model together in batches
+of at most maxTokens tokens. Longer than 1022 residue sequences are embedded with embed.'''
+    embs = [None]*len(seqs)
+    groups = {}
+    for i,seq in enumerate(seqs):
+        if len(seq) > 1022: embs[i] = embed(seq,overlap,maxTokens)
+        else: groups.setdefault(len(seq),[]).append(i)
+    for l,inds in groups.items():
+        bs = max(1,maxTokens//(l+2))
+        for b in range(0,len(inds),bs):
+            part = inds[b:b+bs]
+            for i,e in zip(part,_embedBatch([seqs[i] for i in part])):
+                embs[i] = e
+    return embs
+
+def _windows(l, window, overlap):
+    #(start, stop) of the pieces a long sequence is embedded in. Without overlap
+    #the sequence is cut into nearly equal contiguous pieces, with overlap into
+    #equal length windows that share at least overlap residues with their neighbours.
+    if l <= window: return [(0,l)]
+    if overlap <= 0:
+        piece = int(l/window)+1
         part = l/piece
-        for i in range(piece):
-            st = int(i*part)
-            sp = int((i+1)*part)
-            results = _embed(seq[st:sp])
-            if embtoks is not None:
-                for i in range(len(results)):
-                    embtoks[i] = np.concatenate((embtoks[i][:len(embtoks[i])-1],results[i][1:]),axis=0)
-            else:
-                embtoks = results
-    else:
-        embtoks = _embed(seq)
-    return embtoks
+        return [(int(i*part),int((i+1)*part)) for i in range(piece)]
+    overlap = min(overlap,window//2)
+    k = -(-(l-overlap)//(window-overlap))
+    w = -(-(l+(k-1)*overlap)//k)
+    return [(s,s+w) for s in (round(i*(l-w)/(k-1)) for i in range(k))]
+
+def embed(seq, overlap=0, maxTokens=4096, window=1022):
+    '''Per token embeddings of the last and 13th layers of ESM-1b.
+Sequences longer than window residues are embedded in pieces, pieces of the same
+length go through the model together in batches of at most maxTokens tokens.
+With overlap the pieces overlap by that many residues and the embeddings of
+the shared residues are blended linearly from one piece to the next.'''
+    l = len(seq)
+    if l <= window: return _embed(seq)
+    wins = _windows(l,window,overlap)
+    #blending weights, the weights of two overlapping windows add up to one
+    weights = []
+    for i,(st,sp) in enumerate(wins):
+        left = wins[i-1][1]-st if i > 0 else 0
+        right = sp-wins[i+1][0] if i < len(wins)-1 else 0
+        p = np.arange(sp-st)
+        weights.append(np.minimum(1,np.minimum((p+1)/(left+1),(sp-st-p)/(right+1))).astype(np.float32)[:,None])
+    out = None
+    groups = {}
+    for i,(st,sp) in enumerate(wins):
+        groups.setdefault(sp-st,[]).append(i)
+    for n,inds in groups.items():
+        bs = max(1,maxTokens//(n+2))
+        for b in range(0,len(inds),bs):
+            part = inds[b:b+bs]
+            for i,results in zip(part,_embedBatch([seq[wins[i][0]:wins[i][1]] for i in part])):
+                st,sp = wins[i]
+                if out is None: out = [np.zeros((l+2,r.shape[1]),dtype=r.dtype) for r in results]
+                for o,r in zip(out,results):
+                    o[st+1:sp+1] += weights[i]*r[1:-1]
+                    #begin and end of sequence tokens come from the first and the last piece
+                    if i == 0: o[0] = r[0]
+                    if i == len(wins)-1: o[-1] = r[-1]
+    if overlap > 0:
+        total = np.zeros(l,dtype=np.float32)
+        for (st,sp),w in zip(wins,weights): total[st:sp] += w[:,0]
+        for o in out: o[1:-1] /= total[:,None]
+    return out
@@ -0,0 +1,25 @@
+'''Binary search results.
+
+search --format hits writes one fixed size record per hit instead of tsv rows:
+the query and target positions in their databases, the PROST distance and the
+e-value. Records are written in query order and hits of a query are sorted by
+e-value. GO enrichments are only reported in the tsv format.
+'''
+import os
+import numpy as np
+
+HITS_DTYPE = np.dtype([('query','<u4'),('target','<i8'),('dist','<f4'),('evalue','<f8')])
+
+def packHits(query, targets, dists, evals):
+    '''Hit records of one query.'''
+    hits = np.empty(len(targets),dtype=HITS_DTYPE)
+    hits['query'] = query
+    hits['target'] = targets
+    hits['dist'] = dists
+    hits['evalue'] = evals
+    return hits
+
+def loadHits(path):
+    '''Memory maps a hits file as a structured array with query, target, dist and evalue fields.'''
+    if os.path.getsize(path) == 0: return np.empty(0,dtype=HITS_DTYPE)
+    return np.memmap(path,dtype=HITS_DTYPE,mode='r')
@@ -0,0 +1,69 @@
+'''Coarse clustering prefilter index for large PROST databases.
+
+Targets are clustered with k-means on the L2 distance, which can be computed
+with matrix products, and stored as inverted lists. A search probes the lists
+of the nprobe closest centroids and scores only those targets exactly with
+the L1 distance. PROST e-values need the median and MAD of the distances of a
+query to the whole database, these are estimated from a fixed random sample
+of targets that is stored with the index.
+'''
+import numpy as np
+
+def _assign(x, centroids, chunk=16384):
+    #index of the closest centroid (L2) of every row of x
+    cn = (centroids**2).sum(axis=1)
+    labels = np.empty(len(x),dtype=np.int32)
+    for i in range(0,len(x),chunk):
+        xb = np.asarray(x[i:i+chunk],dtype=np.float32)
+        labels[i:i+chunk] = (cn-2*xb@centroids.T).argmin(axis=1)
+    return labels
+
+def _kmeans(x, k, iters, rng):
+    centroids = x[np.sort(rng.choice(len(x),k,replace=False))].astype(np.float32)
+    for _ in range(iters):
+        labels = _assign(x,centroids)
+        counts = np.bincount(labels,minlength=k)
+        order = np.argsort(labels,kind='stable')
+        starts = np.concatenate([[0],np.cumsum(counts)[:-1]])
+        filled = counts > 0
+        sums = np.add.reduceat(x[order].astype(np.float32),starts[filled],axis=0)
+        centroids[filled] = sums/counts[filled,None]
+        #restart empty clusters from random points
+        empty = np.nonzero(~filled)[0]
+        if len(empty) > 0: centroids[empty] = x[rng.choice(len(x),len(empty),replace=False)]
+    return centroids
+
+def buildIndex(db, nlist=0, iters=10, sample=0, nullSample=20000, seed=0):
+    '''Clusters the rows of a (N,475) database into nlist inverted lists.
+
+    nlist defaults to 4*sqrt(N), k-means is trained on a sample of
+    64*nlist rows unless sample is given. Returns a dict of arrays.'''
+    rng = np.random.default_rng(seed)
+    N = len(db)
+    if nlist <= 0: nlist = int(4*np.sqrt(N))
+    nlist = max(1,min(nlist,N))
+    if sample <= 0: sample = 64*nlist
+    train = np.asarray(db[np.sort(rng.choice(N,min(sample,N),replace=False))])
+    centroids = _kmeans(train,nlist,iters,rng)
+    labels = _assign(db,centroids)
+    ids = np.argsort(labels,kind='stable').astype(np.int64)
+    offsets = np.concatenate([[0],np.cumsum(np.bincount(labels,minlength=nlist))]).astype(np.int64)
+    null = np.sort(rng.choice(N,min(nullSample,N),replace=False)).astype(np.int64)
+    return {'centroids':centroids,'offsets':offsets,'ids':ids,'null':null,'count':np.int64(N)}
+
+def saveIndex(path, index):
+    with open(path,'wb') as f:
+        np.savez(f,**index)
+
+def loadIndex(path):
+    with np.load(path) as f:
+        return {k:f[k] for k in f.files}
+
+def probe(index, queries, nprobe):
+    '''Candidate target ids of every query, the sorted union of the nprobe closest lists.'''
+    centroids,offsets,ids = index['centroids'],index['offsets'],index['ids']
+    q = np.asarray(queries,dtype=np.float32)
+    d = (centroids**2).sum(axis=1)-2*q@centroids.T
+    nprobe = min(nprobe,len(centroids))
+    lists = np.argpartition(d,nprobe-1,axis=1)[:,:nprobe]
+    return [np.sort(np.concatenate([ids[offsets[l]:offsets[l+1]] for l in row])) for row in lists]
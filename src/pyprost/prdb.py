@@ -0,0 +1,348 @@
+'''PROST database (.prdb) storage.
+
+Two on-disk formats are understood:
+
+v1: blosc compressed pickle of [names, quantizations]. The whole file has to be
+    read, decompressed and unpickled before it can be used.
+v2: uncompressed, fixed layout file that can be memory mapped:
+
+    [header 64 bytes]
+    [matrix   capacity x rowbytes int8]   quantizations, row i is entry i
+    [index    (capacity+1) x uint64]      name i is names[index[i]:index[i+1]]
+    [names    utf-8 blob until EOF]
+
+    The header stores the committed entry count. Rows, index entries and
+    names past count are ignored, so a file can be appended to while it is
+    being read. When the capacity is exhausted only the index and names are
+    moved further into the file, the matrix is never rewritten.
+
+    Rows are 8 bit quantizations unless bits 1-4 of the header flags hold a
+    smaller code width, then a row holds the packed codes of one entry, see
+    prosttools.packQuants.
+'''
+import os
+import re
+import struct
+from glob import glob
+import numpy as np
+
+MAGIC = b'PRDB\x00\x02\r\n'
+VERSION = 2
+HEADER = struct.Struct('<8sIIQQIIQQQ')
+HEADER_SIZE = 64
+FLAG_PARSED = 1
+FLAG_BITS_SHIFT = 1
+FLAG_BITS_MASK = 15 << FLAG_BITS_SHIFT
+DIM = 475
+
+def _bits(flags):
+    return (flags & FLAG_BITS_MASK) >> FLAG_BITS_SHIFT or 8
+
+def isPrdb2(path):
+    with open(path,'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def _readHeader(f):
+    f.seek(0)
+    magic,version,flags,count,capacity,dim,rowbytes,matOff,idxOff,namesOff = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC: raise ValueError(f'{f.name} is not a PROST v2 database')
+    if version != VERSION: raise ValueError(f'{f.name} has unsupported version {version}')
+    return dict(flags=flags,count=count,capacity=capacity,dim=dim,rowbytes=rowbytes,
+                matOff=matOff,idxOff=idxOff,namesOff=namesOff)
+
+def _encodeName(name):
+    if type(name) == tuple: return '\t'.join(name).encode()
+    return str(name).encode()
+
+class ProstNames:
+    '''Names of a v2 database. Names are read from disk only when indexed.'''
+    def __init__(self, path, h):
+        self.path = path
+        self.parsed = bool(h['flags'] & FLAG_PARSED)
+        self.namesOff = h['namesOff']
+        self.idxOff = h['idxOff']
+        self.count = h['count']
+        self._open()
+
+    def _open(self):
+        self.index = np.memmap(self.path, dtype='<u8', mode='r', offset=self.idxOff, shape=(self.count+1,))
+        self._f = None
+
+    def __len__(self):
+        return self.count
+
+    def _decode(self, name):
+        name = name.decode()
+        if self.parsed: return tuple(name.split('\t'))
+        return name
+
+    def _get(self, i):
+        if self._f is None: self._f = open(self.path,'rb')
+        start,stop = int(self.index[i]),int(self.index[i+1])
+        self._f.seek(self.namesOff+start)
+        return self._decode(self._f.read(stop-start))
+
+    def _range(self, start, stop):
+        #names start:stop with one read
+        if self._f is None: self._f = open(self.path,'rb')
+        offsets = np.asarray(self.index[start:stop+1],dtype=np.int64)
+        self._f.seek(self.namesOff+int(offsets[0]))
+        blob = self._f.read(int(offsets[-1]-offsets[0]))
+        offsets -= offsets[0]
+        res = np.empty(stop-start,dtype=object)
+        for j in range(stop-start): res[j] = self._decode(blob[offsets[j]:offsets[j+1]])
+        return res
+
+    def __getitem__(self, key):
+        if isinstance(key,(int,np.integer)):
+            if key < 0: key += len(self)
+            if key < 0 or key >= len(self): raise IndexError('name index out of range')
+            return self._get(int(key))
+        if isinstance(key,slice):
+            start,stop,step = key.indices(len(self))
+            if step == 1: return self._range(start,max(start,stop))
+            key = range(start,stop,step)
+        res = np.empty(len(key),dtype=object)
+        for j,i in enumerate(key): res[j] = self[i]
+        return res
+
+    def __iter__(self):
+        for i in range(0,len(self),65536): yield from self._range(i,min(i+65536,len(self)))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['index'],state['_f']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def close(self):
+        if self._f is not None: self._f.close()
+        self._f = None
+
+class ShardedNames:
+    '''Names of several databases indexed as if the databases were concatenated.'''
+    def __init__(self, parts):
+        self.parts = parts
+        self.offsets = np.cumsum([0]+[len(p) for p in parts])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, key):
+        if isinstance(key,(int,np.integer)):
+            if key < 0: key += len(self)
+            if key < 0 or key >= len(self): raise IndexError('name index out of range')
+            p = np.searchsorted(self.offsets,key,side='right')-1
+            return self.parts[p][int(key-self.offsets[p])]
+        if isinstance(key,slice): key = range(*key.indices(len(self)))
+        res = np.empty(len(key),dtype=object)
+        for j,i in enumerate(key): res[j] = self[i]
+        return res
+
+    def __iter__(self):
+        for p in self.parts: yield from p
+
+class ProstDB:
+    '''Memory mapped v2 PROST database. db is a (count,475) int8 array,
+or prosttools.PackedCodes if the database stores packed codes.'''
+    def __init__(self, path):
+        self.path = path
+        with open(path,'rb') as f:
+            h = _readHeader(f)
+        self.count = h['count']
+        self.dim = h['dim']
+        self.bits = _bits(h['flags'])
+        dtype = 'int8' if self.bits == 8 else 'uint8'
+        if h['count'] > 0:
+            self.db = np.memmap(path, dtype=dtype, mode='r', offset=h['matOff'], shape=(h['count'],h['rowbytes']))
+        else: self.db = np.empty((0,h['rowbytes']),dtype=dtype)
+        if self.bits < 8:
+            from .prosttools import PackedCodes
+            self.db = PackedCodes(self.db,self.bits,self.dim)
+        self.names = ProstNames(path, h)
+
+    def __len__(self):
+        return self.count
+
+class PrdbWriter:
+    '''Appends entries to a v2 PROST database.
+
+    Entries become visible to readers when commit() writes the new count into
+    the header. mode='w' creates a new file, mode='a' continues an existing one.
+    With bits 4 or 6 quantizations are stored as packed codes.'''
+    def __init__(self, path, mode='w', capacity=1024, dim=DIM, parsed=None, sync=False, bits=None):
+        self.path = path
+        self.sync = sync
+        if mode == 'a' and os.path.exists(path):
+            self.f = open(path,'r+b')
+            h = _readHeader(self.f)
+            self.flags,self.count,self.capacity = h['flags'],h['count'],h['capacity']
+            self.dim,self.rowbytes = h['dim'],h['rowbytes']
+            self.matOff,self.idxOff,self.namesOff = h['matOff'],h['idxOff'],h['namesOff']
+            self.f.seek(self.idxOff+self.count*8)
+            self.namesEnd = struct.unpack('<Q',self.f.read(8))[0]
+            self.parsed = bool(self.flags & FLAG_PARSED)
+            if parsed is not None and parsed != self.parsed:
+                raise ValueError(f'{path} name format does not match the appended names')
+            self.bits = _bits(self.flags)
+            if bits is not None and bits != self.bits:
+                raise ValueError(f'{path} stores {self.bits} bit codes, not {bits} bit')
+        elif mode in ('w','a'):
+            from .prosttools import packedRowBytes
+            self.f = open(path,'w+b')
+            self.parsed = parsed
+            self.bits = bits or 8
+            if self.bits not in (4,6,8): raise ValueError(f'{self.bits} bit codes are not supported, use 4, 6 or 8')
+            self.flags = FLAG_PARSED if parsed else 0
+            if self.bits < 8: self.flags |= self.bits << FLAG_BITS_SHIFT
+            self.count,self.capacity = 0,max(int(capacity),1)
+            self.dim,self.rowbytes = dim,packedRowBytes(dim,self.bits)
+            self.matOff = HEADER_SIZE
+            self.idxOff = self.matOff+self.capacity*self.rowbytes
+            self.namesOff = self.idxOff+(self.capacity+1)*8
+            self.namesEnd = 0
+            self._writeIndex(0,[0])
+            self._writeHeader()
+        else: raise ValueError(f'unknown mode {mode}')
+        self.pending = 0
+
+    def _writeHeader(self):
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC,VERSION,self.flags,self.count,self.capacity,self.dim,self.rowbytes,
+                                 self.matOff,self.idxOff,self.namesOff).ljust(HEADER_SIZE,b'\x00'))
+
+    def _writeIndex(self, start, offsets):
+        self.f.seek(self.idxOff+start*8)
+        self.f.write(np.asarray(offsets,dtype='<u8').tobytes())
+
+    def _grow(self, need):
+        #move index and names behind the enlarged matrix region. The new
+        #location starts after the current end of file so a crash while
+        #moving leaves the old, committed layout intact.
+        self.f.flush()
+        self.f.seek(0,os.SEEK_END)
+        eof = self.f.tell()
+        capacity = max(2*self.capacity,need,-(-(eof-self.matOff)//self.rowbytes))
+        idxOff = self.matOff+capacity*self.rowbytes
+        namesOff = idxOff+(capacity+1)*8
+        self.f.seek(self.idxOff)
+        index = self.f.read((self.count+self.pending+1)*8)
+        self.f.seek(idxOff)
+        self.f.write(index)
+        self.f.seek(self.namesOff)
+        names = self.f.read(self.namesEnd)
+        self.f.seek(namesOff)
+        self.f.write(names)
+        self.f.flush()
+        if self.sync: os.fsync(self.f.fileno())
+        self.capacity,self.idxOff,self.namesOff = capacity,idxOff,namesOff
+        self._writeHeader()
+        self.f.flush()
+
+    def append(self, name, quant):
+        self.extend([name],[quant])
+
+    def extend(self, names, quants):
+        quants = np.asarray(quants,dtype='int8')
+        if len(names) == 0: return
+        if quants.ndim != 2 or quants.shape[1] != self.dim or len(quants) != len(names):
+            raise ValueError(f'expected {len(names)} rows of {self.dim} values, got {quants.shape}')
+        if self.bits < 8:
+            from .prosttools import packQuants
+            quants = packQuants(quants,self.bits)
+        if self.parsed is None:
+            self.parsed = type(names[0]) == tuple
+            if self.parsed: self.flags |= FLAG_PARSED
+        n = self.count+self.pending
+        if n+len(names) > self.capacity: self._grow(n+len(names))
+        self.f.seek(self.matOff+n*self.rowbytes)
+        self.f.write(np.ascontiguousarray(quants).tobytes())
+        blob = [_encodeName(name) for name in names]
+        self.f.seek(self.namesOff+self.namesEnd)
+        self.f.write(b''.join(blob))
+        offsets = self.namesEnd+np.cumsum([len(b) for b in blob],dtype='u8')
+        self._writeIndex(n+1,offsets)
+        self.namesEnd = int(offsets[-1])
+        self.pending += len(names)
+
+    def commit(self):
+        '''Make appended entries visible to readers.'''
+        self.f.flush()
+        if self.sync: os.fsync(self.f.fileno())
+        self.count += self.pending
+        self.pending = 0
+        self._writeHeader()
+        self.f.flush()
+        if self.sync: os.fsync(self.f.fileno())
+
+    def rollback(self):
+        '''Discard the entries appended since the last commit.'''
+        self.f.seek(self.idxOff+self.count*8)
+        self.namesEnd = struct.unpack('<Q',self.f.read(8))[0]
+        self.pending = 0
+
+    def close(self):
+        if self.f.closed: return
+        self.commit()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _natural(path):
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)',path)]
+
+def shardPaths(target):
+    '''Databases of a file, a directory of .prdb files or a glob pattern.
+Split files of makedb are returned in the order they were written.'''
+    if os.path.isfile(target): return [target]
+    if os.path.isdir(target): target = os.path.join(target,'*.prdb')
+    return sorted((p for p in glob(target) if os.path.isfile(p)),key=_natural)
+
+def loadDB(path):
+    '''Returns (names, quantizations) of a v1 or v2 PROST database.
+v2 databases are memory mapped and their names are read lazily.'''
+    if isPrdb2(path):
+        pdb = ProstDB(path)
+        return pdb.names,pdb.db
+    import blosc
+    from pickle import loads
+    with open(path,'rb') as f:
+        names,db = loads(blosc.decompress(f.read()))
+    return names,db
+
+def _replaceWith(path, write):
+    #names and quantizations may still be memory mapped from path itself,
+    #so the database is written next to it and moved over it when complete
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        write(tmp)
+        os.replace(tmp,path)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+def saveDB(path, names, db, bits=8):
+    '''Writes names and quantizations as a v2 PROST database.'''
+    parsed = len(names) > 0 and type(names[0]) == tuple
+    def write(tmp):
+        with PrdbWriter(tmp, capacity=len(db), dim=np.shape(db)[1] if len(db) else DIM, parsed=parsed, bits=bits) as w:
+            w.extend(names,db)
+    _replaceWith(path,write)
+
+def convertDB(src, dst, chunk=65536, bits=8):
+    '''Converts a v1 (blosc+pickle) PROST database into the v2 format,
+or a v2 database into one with bits wide codes. dst may be src.'''
+    names,db = loadDB(src)
+    parsed = len(names) > 0 and type(names[0]) == tuple
+    def write(tmp):
+        with PrdbWriter(tmp, capacity=len(db), parsed=parsed, bits=bits) as w:
+            for i in range(0,len(db),chunk):
+                w.extend(names[i:i+chunk],db[i:i+chunk])
+    _replaceWith(dst,write)
+    return len(db)
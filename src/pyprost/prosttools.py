@@ -1,8 +1,8 @@
-from .esmts25_13 import embed
-from scipy.fftpack import dct, idct
+from .esmts25_13 import embed,embedBatch
 import numpy as np
 
 def iDCTquant(v,n):
+    from scipy.fftpack import dct, idct
     f = dct(v.T, type=2, norm='ortho')
     trans = idct(f[:,:n], type=2, norm='ortho')
     for i in range(len(trans)):
@@ -12,6 +12,7 @@ def iDCTquant(v,n):
 def scale(v):
     M = np.max(v)
     m = np.min(v)
+    if M == m: return np.zeros_like(v)
     return (v - m) / float(M - m)
 
 def quant2D(emb,n=5,m=44):
@@ -20,11 +21,163 @@ def quant2D(emb,n=5,m=44):
     ddct = ddct.reshape(n*m)
     return (ddct*127).astype('int8')
 
-def quantSeq(seq):
-    e = embed(seq.upper())
-    q25_544 = quant2D(e[1],5,44)
-    q13_385 = quant2D(e[0],3,85)
-    return np.concatenate([q25_544,q13_385])
+def _iDCTquantRows(v,n):
+    #iDCTquant of every (rows,l) matrix of a (B,rows,l) stack, without the final transpose.
+    #The transforms and scale() run along the last axis, so every value is computed
+    #exactly as in iDCTquant.
+    from scipy.fftpack import dct, idct
+    f = dct(v, type=2, norm='ortho', axis=-1)
+    trans = idct(f[...,:n], type=2, norm='ortho', axis=-1)
+    M = trans.max(axis=-1,keepdims=True)
+    m = trans.min(axis=-1,keepdims=True)
+    return np.divide(trans-m,M-m,out=np.zeros_like(trans),where=M!=m)
+
+def quant2DBatch(embs,n=5,m=44):
+    '''quant2D of a list of embeddings as a (B,n*m) int8 array, equal to quant2D of each.
+Embeddings of the same length are transformed together, the second transform runs
+over the whole batch at once.'''
+    d = np.shape(embs[0])[1]
+    lens = {}
+    for i,e in enumerate(embs):
+        lens.setdefault(len(e)-2,[]).append(i)
+    dct = None
+    for l,inds in lens.items():
+        if l < n: raise ValueError(f'at least {n} residues are needed for quantization, got {l}')
+        e = np.stack([embs[i][1:l+1] for i in inds])
+        rows = _iDCTquantRows(e.transpose(0,2,1),n)
+        if dct is None: dct = np.empty((len(embs),n,d),dtype=rows.dtype)
+        dct[inds] = rows.transpose(0,2,1)
+    ddct = _iDCTquantRows(dct,m)
+    ddct = ddct.reshape(len(embs),n*m)
+    return (ddct*127).astype('int8')
+
+def quantEmbBatch(embs):
+    '''Quantizes a list of embed() results into a (B,475) int8 array.'''
+    q25_544 = quant2DBatch([e[1] for e in embs],5,44)
+    q13_385 = quant2DBatch([e[0] for e in embs],3,85)
+    return np.concatenate([q25_544,q13_385],axis=1)
+
+def quantEmb(e):
+    return quantEmbBatch([e])[0]
+
+def quantSeq(seq,overlap=0):
+    return quantEmb(embed(seq.upper(),overlap))
+
+def quantSeqBatch(seqs,maxTokens=4096,overlap=0):
+    '''Quantizes a list of sequences into a (len(seqs),475) int8 array.
+Equal length sequences are embedded together, see esmts25_13.embedBatch. Codes
+can differ by 1 from quantSeq of the same sequence in rare cases.'''
+    return quantEmbBatch(embedBatch([seq.upper() for seq in seqs],maxTokens,overlap))
+
+def packedRowBytes(dim,bits):
+    return -(-dim*bits//8)
+
+def packQuants(quants,bits):
+    '''Packs (N,d) quantizations into bits wide codes, a (N,packedRowBytes(d,bits)) uint8 array.
+Quantizations lie in [0,127], a code keeps the bits highest of their 7 bits.'''
+    quants = np.asarray(quants)
+    if bits == 8: return quants.astype(np.uint8)
+    c = np.right_shift(quants.astype(np.uint8),7-bits)
+    if bits == 4:
+        c = np.pad(c,((0,0),(0,len(c[0])%2)))
+        return c[:,0::2] | (c[:,1::2] << 4)
+    if bits == 6:
+        c = np.pad(c,((0,0),(0,-len(c[0])%4)))
+        c0,c1,c2,c3 = c[:,0::4],c[:,1::4],c[:,2::4],c[:,3::4]
+        packed = np.stack([c0 | (c1 << 6),(c1 >> 2) | (c2 << 4),(c2 >> 4) | (c3 << 2)],axis=2)
+        return packed.reshape(len(c),-1)[:,:packedRowBytes(len(quants[0]),bits)]
+    raise ValueError(f'{bits} bit codes are not supported, use 4, 6 or 8')
+
+def unpackCodes(packed,bits,dim):
+    '''The (N,dim) uint8 codes of packQuants output.'''
+    packed = np.asarray(packed,dtype=np.uint8)
+    if bits == 8: return packed
+    if bits == 4:
+        c = np.empty((len(packed),2*packed.shape[1]),dtype=np.uint8)
+        np.bitwise_and(packed,15,out=c[:,0::2])
+        np.right_shift(packed,4,out=c[:,1::2])
+        return c[:,:dim]
+    b = np.pad(packed,((0,0),(0,-packed.shape[1]%3)))
+    b0,b1,b2 = b[:,0::3],b[:,1::3],b[:,2::3]
+    c = np.stack([b0 & 63,(b0 >> 6) | ((b1 & 15) << 2),(b1 >> 4) | ((b2 & 3) << 4),b2 >> 2],axis=2)
+    return c.reshape(len(b),-1)[:,:dim]
+
+class PackedCodes:
+    '''(N,dim) quantizations stored as packed bits wide codes.
+
+    Indexing with a slice or an array gives PackedCodes, an integer gives
+    the row and np.asarray the int8 quantizations reconstructed from the codes.'''
+    def __init__(self, packed, bits, dim=475):
+        self.packed = packed
+        self.bits = bits
+        self.dim = dim
+        self.step = 1 << (7-bits)
+
+    def __len__(self):
+        return len(self.packed)
+
+    @property
+    def shape(self):
+        return (len(self.packed),self.dim)
+
+    def __getitem__(self, key):
+        if isinstance(key,(int,np.integer)): return np.asarray(PackedCodes(self.packed[key][None],self.bits,self.dim))[0]
+        return PackedCodes(self.packed[key],self.bits,self.dim)
+
+    def codes(self, start=0, stop=None):
+        return unpackCodes(self.packed[start:stop],self.bits,self.dim)
+
+    def __array__(self, dtype=None, copy=None):
+        #codes are the centers of the value ranges they stand for
+        q = (self.codes().astype(np.int8)*self.step+self.step//2).astype(np.int8)
+        return q if dtype is None else q.astype(dtype)
 
 def prostDistance(emb1,emb2):
-    return abs(emb1-emb2).sum()/2
+    return abs(np.asarray(emb1,dtype=np.int16)-emb2).sum()/2
+
+def l1Distances(queries,targets,out=None,tile=512):
+    '''L1 distances of every query to every target as a (Q,T) int32 array.
+Targets are widened to int16 one cache sized tile at a time and all queries
+are compared against a tile before moving on to the next one, so the target
+matrix is streamed from memory once per call instead of once per query.
+PackedCodes targets are unpacked a tile at a time and compared with the codes
+of the queries, distances are scaled to the units of 8 bit quantizations.'''
+    queries = np.asarray(queries)
+    if queries.ndim == 1: queries = queries[None]
+    step = targets.step if isinstance(targets,PackedCodes) else 1
+    queries = (queries//step).astype(np.int16)
+    T = len(targets)
+    if out is None: out = np.empty((len(queries),T),dtype=np.int32)
+    tw = np.empty((min(tile,T),queries.shape[1]),dtype=np.int16)
+    diff = np.empty_like(tw)
+    for t0 in range(0,T,tile):
+        t1 = min(t0+tile,T)
+        tb,d = tw[:t1-t0],diff[:t1-t0]
+        tb[...] = targets[t0:t1] if step == 1 else targets.codes(t0,t1)
+        for i,q in enumerate(queries):
+            np.subtract(tb,q,out=d)
+            np.absolute(d,out=d)
+            d.sum(axis=1,dtype=np.int32,out=out[i,t0:t1])
+    if step > 1: out *= step
+    return out
+
+def histMedianMAD(counts,n=None):
+    '''Median and median absolute deviation of the values described by a histogram,
+counts[v] being the number of times the non negative integer v occurs.'''
+    if n is None: n = int(counts.sum())
+    c = np.cumsum(counts)
+    #twice the median is an integer, np.median averages the two middle values
+    med2 = np.searchsorted(c,(n-1)//2,side='right')+np.searchsorted(c,n//2,side='right')
+    vals = np.nonzero(counts)[0]
+    dev = np.cumsum(np.bincount(np.abs(2*vals-med2),weights=counts[vals]))
+    mad4 = np.searchsorted(dev,(n-1)//2,side='right')+np.searchsorted(dev,n//2,side='right')
+    return med2/2,mad4/4
+
+def medianMAD(dists):
+    '''np.median and scipy.stats.median_abs_deviation of non negative integer distances.
+Distances are bounded integers, so both come from one histogram instead of two selection passes.'''
+    return histMedianMAD(np.bincount(dists),len(dists))
+
+def prostDistanceMatrix(queries,targets):
+    '''prostDistance of every query to every target as a (Q,T) array.'''
+    return l1Distances(queries,targets)/2
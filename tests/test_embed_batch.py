@@ -0,0 +1,24 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('esm')
+from pyprost import esmts25_13
+from pyprost.prosttools import quantSeq,quantSeqBatch
+
+#the model is never downloaded by the tests
+pytestmark = pytest.mark.skipif(not os.path.exists(esmts25_13.prostdir+'/traced_esm1b_25_13.pt'),
+                                reason='the traced ESM-1b model is not in PROSTDIR')
+
+AMINO = np.array(list('ACDEFGHIKLMNPQRSTVWY'))
+
+def test_batch_matches_quantSeq():
+    rng = np.random.default_rng(0)
+    #equal lengths share a batch, mixed lengths get their own
+    seqs = [''.join(rng.choice(AMINO,l)) for l in [60,60,60,45,120,200,45]]
+    batch = quantSeqBatch(seqs,maxTokens=256)
+    single = np.stack([quantSeq(s) for s in seqs])
+    assert batch.shape == single.shape == (len(seqs),475)
+    #batched kernels round differently, codes may be off by one
+    assert np.abs(batch.astype(int)-single).max() <= 1
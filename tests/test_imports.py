@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+
+def _modules(code):
+    out = subprocess.run([sys.executable,'-c',code+'\nimport sys; print(" ".join(sys.modules))'],
+                         capture_output=True,text=True,check=True,
+                         env=dict(os.environ,PYTHONPATH=os.pathsep.join(sys.path))).stdout
+    return set(out.split())
+
+def test_submodule_import_is_cheap():
+    #commands that only read databases must not load the embedding code
+    loaded = _modules('import pyprost.prdb')
+    assert not loaded & {'torch','esm','pyprost.prosttools','pyprost.esmts25_13'}
+
+def test_package_names():
+    import pyprost
+    from pyprost import quantSeqBatch,loadDB
+    assert callable(quantSeqBatch) and callable(loadDB)
+    assert 'torch' not in _modules('from pyprost import quantSeq,ProstDB,EmbeddingCache,loadHits')
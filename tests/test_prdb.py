@@ -0,0 +1,23 @@
+import numpy as np
+from pyprost.prdb import loadDB,saveDB,convertDB
+
+def _db(path, n=50):
+    quants = np.random.default_rng(0).integers(0,128,(n,475)).astype(np.int8)
+    saveDB(path,[f'P{i}' for i in range(n)],quants)
+    return quants
+
+def test_save_in_place(tmp_path):
+    #the source is memory mapped from the destination while it is written
+    path = str(tmp_path/'db.prdb')
+    quants = _db(path)
+    names,db = loadDB(path)
+    saveDB(path,[n.lower() for n in names],db)
+    names,db = loadDB(path)
+    assert names[-1] == 'p49' and np.array_equal(np.asarray(db),quants)
+
+def test_convert_in_place(tmp_path):
+    path = str(tmp_path/'db.prdb')
+    quants = _db(path)
+    assert convertDB(path,path) == len(quants)
+    assert np.array_equal(np.asarray(loadDB(path)[1]),quants)
+    assert [p.name for p in tmp_path.iterdir()] == ['db.prdb']
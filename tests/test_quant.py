@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from pyprost.prosttools import quant2D,quant2DBatch
+
+SHAPES = [(5,44),(3,85)]
+
+def _embeddings(rng,lens,d=1280):
+    return [rng.normal(size=(l+2,d)).astype(np.float32) for l in lens]
+
+@pytest.mark.parametrize('n,m',SHAPES)
+def test_batch_matches_quant2D(n,m):
+    rng = np.random.default_rng(0)
+    #mixed lengths and a group of equal lengths that are transformed together
+    embs = _embeddings(rng,list(rng.integers(n,400,20))+[50]*4)
+    batch = quant2DBatch(embs,n,m)
+    assert batch.shape == (len(embs),n*m) and batch.dtype == np.int8
+    assert np.array_equal(batch,np.stack([quant2D(e,n,m) for e in embs]))
+
+@pytest.mark.parametrize('n,m',SHAPES)
+@pytest.mark.parametrize('case',['all','row','column'])
+def test_constant_embeddings(n,m,case):
+    e = np.random.default_rng(1).normal(size=(52,1280)).astype(np.float32)
+    if case == 'all': e[:] = 1
+    elif case == 'row': e[10] = 2
+    else: e[:,::3] = -1.5
+    assert np.array_equal(quant2DBatch([e],n,m)[0],quant2D(e,n,m))
+
+def test_too_short():
+    with pytest.raises(ValueError):
+        quant2DBatch(_embeddings(np.random.default_rng(2),[3]))